@@ -0,0 +1,139 @@
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+import gevent
+import gevent.event
+
+
+class Alarm(object):
+
+    "handle of a scheduled callback"
+
+    def __init__(self, deadline, cb, args, scheduler=None):
+        self.deadline = deadline
+        self.cb = cb
+        self.args = args
+        self.scheduler = scheduler  # while queued there
+        self.active = True
+
+    def __repr__(self):
+        status = 'active' if self.active else 'done'
+        cb = getattr(self.cb, '__name__', self.cb)
+        return '<Alarm(%s at=%r cb=%s)>' % (status, self.deadline, cb)
+
+    def cancel(self):
+        if self.active:
+            self.active = False
+            if self.scheduler:
+                self.scheduler.on_cancel(self)
+
+    def fire(self):
+        if self.active:
+            self.active = False
+            self.cb(*self.args)
+
+
+class AlarmScheduler(object):
+
+    """
+    Runs the alarms of a service from a single greenlet, only due alarms get their own.
+
+    Alarms are kept in a heap by deadline. Cancelled alarms stay there until they are
+    due, or until most entries are cancelled and the heap is compacted.
+    """
+
+    min_compact_size = 64
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []  # (deadline, seq, alarm)
+        self.seq = itertools.count()  # alarms w/ the same deadline fire in order
+        self.num_live = 0
+        self.wakeup = gevent.event.Event()
+        self.greenlet = None
+
+    def __repr__(self):
+        return '<AlarmScheduler(live=%d queued=%d)>' % (self.num_live, len(self.heap))
+
+    def __len__(self):
+        return self.num_live
+
+    def schedule(self, delay, cb, *args):
+        alarm = Alarm(self.clock() + delay, cb, args, scheduler=self)
+        heapq.heappush(self.heap, (alarm.deadline, next(self.seq), alarm))
+        self.num_live += 1
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        elif self.heap[0][2] is alarm:
+            self.wakeup.set()  # earlier than the one waited for
+        return alarm
+
+    def on_cancel(self, alarm):
+        alarm.scheduler = None
+        self.num_live -= 1
+        if len(self.heap) > self.min_compact_size and self.num_live < len(self.heap) / 4:
+            self.heap = [e for e in self.heap if e[2].active]
+            heapq.heapify(self.heap)
+
+    def pop_due(self):
+        now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            alarm = heapq.heappop(self.heap)[2]
+            if alarm.active:
+                alarm.scheduler = None
+                self.num_live -= 1
+                due.append(alarm)
+        return due
+
+    def run(self):
+        while True:
+            for alarm in self.pop_due():
+                gevent.spawn(alarm.fire)
+            timeout = max(0, self.heap[0][0] - self.clock()) if self.heap else None
+            self.wakeup.clear()
+            self.wakeup.wait(timeout)
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+
+class EventAlarms(object):
+
+    """
+    Alarms fired once on the next event, e.g. a new transaction, instead of a deadline.
+
+    Alarms are keyed by (cb, args), registering the same again returns the pending one.
+    """
+
+    def __init__(self):
+        self.alarms = OrderedDict()  # (cb, args): alarm
+
+    def __repr__(self):
+        return '<EventAlarms(pending=%d)>' % len(self)
+
+    def __len__(self):
+        return len(self.alarms)
+
+    def register(self, cb, *args):
+        key = (cb, args)
+        if key in self.alarms:
+            return self.alarms[key]
+        alarm = Alarm(None, cb, args, scheduler=self)
+        self.alarms[key] = alarm
+        return alarm
+
+    def on_cancel(self, alarm):
+        alarm.scheduler = None
+        del self.alarms[(alarm.cb, alarm.args)]
+
+    def trigger(self):
+        "called on the event"
+        pending = self.alarms.values()
+        self.alarms.clear()
+        for alarm in pending:
+            alarm.scheduler = None
+            alarm.fire()
@@ -0,0 +1,64 @@
+class BatchingPolicy(object):
+
+    """
+    Decides when pending txs are proposed, so blocks can amortize the consensus costs.
+
+    A batch is due once the pending txs reach min_txs or min_gas, or window secs after
+    the first of them arrived, but not before min_interval secs after the last block.
+    Within the window, proposals are only held while more txs are expected at the
+    measured arrival rate.
+    With the defaults txs are proposed as soon as they arrive.
+    """
+
+    rate_smoothing = 0.2  # weight of the last measurement
+
+    def __init__(self, window=0, min_txs=0, min_gas=0, min_interval=0):
+        self.window = window
+        self.min_txs = min_txs
+        self.min_gas = min_gas
+        self.min_interval = min_interval
+        self.rate = None  # txs / sec
+        self.last_arrival = None
+        self.first_pending = None  # arrival of the first tx not yet in a block
+        self.last_block = None
+
+    def __repr__(self):
+        return '<BatchingPolicy(window=%r min_txs=%d min_gas=%d rate=%r)>' % \
+            (self.window, self.min_txs, self.min_gas, self.rate)
+
+    def on_transactions(self, now, num):
+        if self.last_arrival is not None:
+            rate = float(num) / max(now - self.last_arrival, 0.001)
+            self.rate = rate if self.rate is None else \
+                self.rate_smoothing * rate + (1 - self.rate_smoothing) * self.rate
+        self.last_arrival = now
+        if self.first_pending is None:
+            self.first_pending = now
+
+    def on_block(self, now, num_pending):
+        self.last_block = now
+        self.first_pending = now if num_pending else None
+
+    def expected_rate(self, now):
+        "the arrival rate, decaying if the expected txs did not arrive"
+        if self.rate is None:
+            return None
+        idle = now - self.last_arrival
+        return min(self.rate, 1. / idle) if idle > 0 else self.rate
+
+    def delay(self, now, num_txs, startgas):
+        "secs until the pending txs are due, None w/o pending txs"
+        if not num_txs:
+            return None
+        delay = 0
+        if self.last_block is not None:
+            delay = self.min_interval - (now - self.last_block)
+        if not (self.min_txs and num_txs >= self.min_txs or
+                self.min_gas and startgas >= self.min_gas):
+            first = now if self.first_pending is None else self.first_pending
+            remaining = self.window - (now - first)
+            rate = self.expected_rate(now)
+            if rate is not None and rate * remaining < 1:
+                remaining = 0  # no further txs expected within the window
+            delay = max(delay, remaining)
+        return max(0, delay)
@@ -0,0 +1,73 @@
+import time
+import rlp
+from ethereum import processblock, opcodes
+from ethereum.blocks import Block
+from ethereum.config import Env
+from ethereum.db import OverlayDB
+from ethereum.exceptions import InvalidTransaction
+from ethereum.slogging import get_logger
+log = get_logger('hdc.builder')
+
+
+class BlockBuilder(object):
+
+    """
+    Assembles blocks from pending txs, taken in the given order, within a budget:
+
+        gas_target: gas used by the txs, 0 for the gas limit of the block
+        max_size: bytes of the rlp encoded txs, 0 for no limit
+        max_time: secs spent on applying txs, so the proposal goes out in time
+
+    Txs which don't fit, and the later ones of their senders, are left for the next block.
+    Txs which can never be included, e.g. exceeding the gas limit, are reported as invalid.
+    """
+
+    def __init__(self, gas_target=0, max_size=0, max_time=0, clock=time.time):
+        self.gas_target = gas_target
+        self.max_size = max_size
+        self.max_time = max_time
+        self.clock = clock
+
+    def __repr__(self):
+        return '<BlockBuilder(gas_target=%d max_size=%d max_time=%r)>' % \
+            (self.gas_target, self.max_size, self.max_time)
+
+    def build(self, parent, coinbase, transactions, timestamp=None):
+        "returns the finalized block and the txs which turned out to be invalid"
+        start = self.clock()
+        timestamp = timestamp or max(int(time.time()), parent.timestamp + 1)
+        env = Env(OverlayDB(parent.db), parent.config, parent.env.global_config)
+        block = Block.init_from_parent(parent, coinbase, timestamp=timestamp, env=env)
+        gas_target = min(self.gas_target or block.gas_limit, block.gas_limit)
+        size = 0
+        skipped, invalid = set(), []  # senders w/ txs left for the next block, invalid txs
+        for tx in transactions:
+            if self.max_time and self.clock() - start > self.max_time:
+                log.debug('out of time', num_txs=block.transaction_count)
+                break
+            if gas_target - block.gas_used < opcodes.GTXCOST:
+                break  # full
+            if tx.sender in skipped:
+                continue
+            if tx.startgas > block.gas_limit:
+                log.debug('invalid tx', error='startgas exceeds the block gas limit')
+                skipped.add(tx.sender)
+                invalid.append(tx)
+                continue
+            tx_size = len(rlp.encode(tx))
+            if block.gas_used + tx.startgas > gas_target or \
+                    self.max_size and size + tx_size > self.max_size:
+                skipped.add(tx.sender)
+                continue
+            try:
+                processblock.apply_transaction(block, tx)
+            except InvalidTransaction as e:
+                log.debug('invalid tx', error=e)
+                skipped.add(tx.sender)
+                invalid.append(tx)
+                continue
+            size += tx_size
+        block.finalize()
+        log.debug('built block', block=block, num_txs=block.transaction_count,
+                  gas_used=block.gas_used, size=size, elapsed=self.clock() - start)
+        return block, invalid
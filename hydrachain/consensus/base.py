@@ -12,11 +12,11 @@ from ethereum.utils import big_endian_to_int
 from bitcoin import encode_pubkey, N, P
 import rlp
 from rlp.sedes import big_endian_int, binary
-from rlp.sedes import CountableList
+from rlp.sedes import CountableList, List
 from rlp.utils import encode_hex
 from ethereum.blocks import BlockHeader
 from ethereum.transactions import Transaction
-from hydrachain.utils import sha3, phx
+from hydrachain.utils import sha3, phx, LRUCache
 
 
 def ishash(h):
@@ -31,11 +31,71 @@ class InvalidSignature(Exception):
     pass
 
 
+def recover_address(rawhash, v, r, s):
+    "returns the address which signed rawhash"
+    if r >= N or s >= P or v < 27 or v > 28 or r == 0 or s == 0:
+        raise InvalidSignature()
+    pub = ecdsa_recover_raw(rawhash, (v, r, s))
+    if pub is False or pub == (0, 0):
+        raise InvalidSignature()
+    pub = encode_pubkey(pub, 'bin')
+    return sha3(pub[1:])[-20:]
+
+
+signature_fields = ('v', 'r', 's')
+
+
+# process wide cache of verified signatures: (rawhash, v, r, s) > address
+# the same vote is received standalone and in the locksets of proposals, readys and status
+signature_cache = LRUCache(max_items=8192)
+
+
+class RLPHashableMeta(type):
+
+    "precomputes the per class field names and the sedes used for signing and hashing"
+
+    def __init__(cls, name, bases, attrs):
+        super(RLPHashableMeta, cls).__init__(name, bases, attrs)
+        cls._field_names = frozenset(field for field, _ in cls.fields)
+        if cls._field_names.issuperset(signature_fields):
+            cls._unsigned_sedes = cls.exclude(signature_fields)
+
+            class HashSerializable(rlp.Serializable):
+                fields = [(field, sedes) for field, sedes in cls.fields
+                          if field not in signature_fields] + [('_sender', binary)]
+            cls._hash_sedes = HashSerializable
+
+
 class RLPHashable(rlp.Serializable):
 
+    """
+    the hash (and the rlp encoding) is cached on frozen instances,
+    i.e. the ones deserialized from the wire or the database.
+    setting a field resets the caches.
+    """
+    __metaclass__ = RLPHashableMeta
+
+    _cached_hash = None
+
+    def __setattr__(self, attr, value):
+        super(RLPHashable, self).__setattr__(attr, value)
+        if attr in self._field_names:
+            self._reset_caches()
+
+    def _reset_caches(self):
+        d = self.__dict__
+        d.pop('_cached_rlp', None)
+        d.pop('_cached_hash', None)
+
+    def _cache(self, attr, value):
+        "store value, if the instance is frozen"
+        if not self.is_mutable():
+            self.__dict__[attr] = value
+        return value
+
     @property
     def hash(self):
-        return sha3(rlp.encode(self))
+        return self._cached_hash or self._cache('_cached_hash', sha3(rlp.encode(self)))
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.hash == other.hash
@@ -66,10 +126,15 @@ class Signed(RLPHashable):
     ]
 
     _sender = None
+    _cached_rawhash = None
 
     def __init__(self, *args, **kargs):
         super(Signed, self).__init__(*args, **kargs)
 
+    def _reset_caches(self):
+        super(Signed, self)._reset_caches()
+        self.__dict__.pop('_cached_rawhash', None)
+
     def sign(self, privkey):
         """Sign this with a private key"""
         if self.v:
@@ -77,8 +142,7 @@ class Signed(RLPHashable):
 
         if privkey in (0, '', '\x00' * 32):
             raise InvalidSignature("Zero privkey cannot sign")
-        rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
-        self.v, self.r, self.s = ecdsa_sign_raw(rawhash, privkey)
+        self.v, self.r, self.s = ecdsa_sign_raw(self.rawhash, privkey)
         self._sender = None
         return self
 
@@ -88,30 +152,33 @@ class Signed(RLPHashable):
             self._sender = self.recover_sender()
         return self._sender
 
+    @property
+    def rawhash(self):
+        "hash of the unsigned message"
+        return self._cached_rawhash or \
+            self._cache('_cached_rawhash', sha3(rlp.encode(self, self._unsigned_sedes)))
+
+    def signature_key(self):
+        "(rawhash, v, r, s) i.e. all that is needed to recover the sender"
+        return self.rawhash, self.v, self.r, self.s
+
     def recover_sender(self):
         if self.v:
-            if self.r >= N or self.s >= P or self.v < 27 or self.v > 28 \
-               or self.r == 0 or self.s == 0:
-                raise InvalidSignature()
-            rlpdata = rlp.encode(self, self.__class__.exclude(['v', 'r', 's']))
-            rawhash = sha3(rlpdata)
-            pub = ecdsa_recover_raw(rawhash, (self.v, self.r, self.s))
-            if pub is False or pub == (0, 0):
-                raise InvalidSignature()
-            pub = encode_pubkey(pub, 'bin')
-            return sha3(pub[1:])[-20:]
+            key = self.signature_key()
+            sender = signature_cache.get(key)
+            if sender is None:
+                sender = recover_address(*key)
+                signature_cache[key] = sender
+            return sender
 
     @property
     def hash(self):
         "signatures are non deterministic"
+        if self._cached_hash:
+            return self._cached_hash
         if self.sender is None:
             raise MissingSignatureError()
-
-        class HashSerializable(rlp.Serializable):
-            fields = [(field, sedes) for field, sedes in self.fields
-                      if field not in ('v', 'r', 's')] + [('_sender', binary)]
-            _sedes = None
-        return sha3(rlp.encode(self, HashSerializable))
+        return self._cache('_cached_hash', sha3(rlp.encode(self, self._hash_sedes)))
 
 # Votes
 
@@ -165,6 +232,11 @@ class DoubleVotingError(InvalidVoteError):
 
 class LockSet(RLPHashable):  # careful, is mutable!
 
+    """
+    votes are indexed by signer and tallied by blockhash,
+    so lookups and the quorum checks don't need to scan the votes.
+    """
+
     fields = [
         ('num_eligible_votes', big_endian_int),
         ('votes', CountableList(Vote))
@@ -175,9 +247,42 @@ class LockSet(RLPHashable):  # careful, is mutable!
     def __init__(self, num_eligible_votes, votes=None):
         self.num_eligible_votes = num_eligible_votes
         self.votes = []
-        for v in votes or []:
+        votes = votes or []
+        recover_senders(votes)
+        for v in votes:
             self.add(v)
 
+    def __setattr__(self, attr, value):
+        super(LockSet, self).__setattr__(attr, value)
+        if attr == 'votes':
+            self._reindex()
+
+    def _reindex(self):
+        d = self.__dict__
+        d['_by_signer'] = dict()  # sender > vote
+        d['_tally'] = Counter()  # blockhash > number of VoteBlocks
+        d['_hr'] = None
+        for v in self.votes:
+            self._index(v)
+        self._reset_caches()
+
+    def _index(self, vote):
+        self._by_signer[vote.sender] = vote
+        if isinstance(vote, VoteBlock):
+            self._tally[vote.blockhash] += 1
+        self.__dict__['_hr'] = vote.hr
+
+    def _unindex(self, vote):
+        del self._by_signer[vote.sender]
+        if isinstance(vote, VoteBlock):
+            self._tally[vote.blockhash] -= 1
+            if not self._tally[vote.blockhash]:
+                del self._tally[vote.blockhash]
+
+    def _reset_caches(self):
+        super(LockSet, self)._reset_caches()
+        self.__dict__.pop('_blockhashes', None)
+
     # @property
     # def size(self):
     #     return len(self.votes) * 67 + 5
@@ -208,16 +313,20 @@ class LockSet(RLPHashable):  # careful, is mutable!
         assert isinstance(vote, Vote)
         if not vote.sender:
             raise InvalidVoteError('no signature')
-        if vote not in self.votes:
-            if len(self) and self.hr != vote.hr:
-                raise InvalidVoteError('inconsistent height, round')
-            signee = self.signee
-            if vote.sender in signee:
-                if not force_replace:
-                    raise DoubleVotingError(vote.sender)  # different votes on the same H,R
-                self.votes.remove(self.votes[signee.index(vote.sender)])
-            self.votes.append(vote)
-            return True
+        other = self._by_signer.get(vote.sender)
+        if other is not None and other == vote:
+            return
+        if len(self) and self.hr != vote.hr:
+            raise InvalidVoteError('inconsistent height, round')
+        if other is not None:
+            if not force_replace:
+                raise DoubleVotingError(vote.sender)  # different votes on the same H,R
+            self.votes.remove(other)
+            self._unindex(other)
+        self.votes.append(vote)
+        self._index(vote)
+        self._reset_caches()
+        return True
 
     def __len__(self):
         return len(self.votes)
@@ -225,22 +334,43 @@ class LockSet(RLPHashable):  # careful, is mutable!
     def __iter__(self):
         return iter(self.votes)
 
+    def __contains__(self, vote):
+        if not isinstance(vote, Vote):
+            return False
+        other = self._by_signer.get(vote.sender)
+        return other is not None and other == vote
+
+    def get(self, sender):
+        "the vote of sender or None"
+        return self._by_signer.get(sender)
+
     @property
     def signee(self):
         return [v.sender for v in self.votes]
 
+    def _sorted_blockhashes(self):
+        bhs = self.__dict__.get('_blockhashes')
+        if bhs is None:
+            # deterministc sort necessary
+            bhs = sorted(self._tally.items(), key=lambda x: (x[1], x[0]), reverse=True)
+            self.__dict__['_blockhashes'] = bhs
+        return bhs
+
     def blockhashes(self):
         assert self.is_valid
-        c = Counter(v.blockhash for v in self.votes if isinstance(v, VoteBlock))
-        # deterministc sort necessary
-        return sorted(c.most_common(), cmp=lambda a, b: cmp((b[1], b[0]), (a[1], a[0])))
+        return list(self._sorted_blockhashes())
+
+    def _top(self):
+        "(blockhash, count) of the block with most votes"
+        bhs = self._sorted_blockhashes()
+        if bhs:
+            return bhs[0]
+        return None, 0
 
     @property
     def hr(self):
         assert len(self), 'no votes, can not determin height'
-        h = set([(v.height, v.round) for v in self.votes])
-        assert len(h) == 1, len(h)
-        return h.pop()
+        return self._hr
 
     height = property(lambda self: self.hr[0])
     round = property(lambda self: self.hr[1])
@@ -256,9 +386,9 @@ class LockSet(RLPHashable):  # careful, is mutable!
         there is a quorum.
         """
         assert self.is_valid
-        bhs = self.blockhashes()
-        if bhs and bhs[0][1] > 2 / 3. * self.num_eligible_votes:
-            return bhs[0][0]
+        blockhash, count = self._top()
+        if count > 2 / 3. * self.num_eligible_votes:
+            return blockhash
 
     @property
     def has_noquorum(self):
@@ -266,8 +396,8 @@ class LockSet(RLPHashable):  # careful, is mutable!
         less than 1/3 of the known votes are on the same block
         """
         assert self.is_valid
-        bhs = self.blockhashes()
-        if not bhs or bhs[0][1] <= 1 / 3. * self.num_eligible_votes:
+        blockhash, count = self._top()
+        if count <= 1 / 3. * self.num_eligible_votes:
             assert not self.has_quorum_possible
             return True
 
@@ -281,9 +411,9 @@ class LockSet(RLPHashable):  # careful, is mutable!
         if self.has_quorum:
             return
         assert self.is_valid  # we could tell that earlier
-        bhs = self.blockhashes()
-        if bhs and bhs[0][1] > 1 / 3. * self.num_eligible_votes:
-            return bhs[0][0]
+        blockhash, count = self._top()
+        if count > 1 / 3. * self.num_eligible_votes:
+            return blockhash
 
     def check(self):
         "either invalid or one of quorum, noquorum, quorumpossible"
@@ -296,6 +426,131 @@ class LockSet(RLPHashable):  # careful, is mutable!
 ############
 
 
+def signed_objects(*objs):
+    "returns the Signed objects and all votes of the locksets they carry"
+    found = []
+    for o in objs:
+        if isinstance(o, LockSet):
+            found.extend(o.votes)
+        elif isinstance(o, Signed):
+            found.append(o)
+            for field, _ in o.fields:
+                ls = getattr(o, field)
+                if isinstance(ls, LockSet):
+                    found.extend(ls.votes)
+    return found
+
+
+def recover_senders(signed):
+    """
+    recovers the senders of many Signed objects in one pass.
+    signatures are pooled by (rawhash, v, r, s), so every distinct signature is
+    recovered once and the sender is set on all objects carrying it.
+    known signatures are looked up in the signature_cache.
+    objects with invalid signatures are skipped, accessing their sender raises.
+    returns the number of signatures which had to be recovered.
+    """
+    pool = dict()
+    for obj in signed:
+        assert isinstance(obj, Signed)
+        if obj._sender or not obj.v:
+            continue
+        pool.setdefault(obj.signature_key(), []).append(obj)
+    recovered = 0
+    for key, objs in pool.items():
+        sender = signature_cache.get(key)
+        if sender is None:
+            try:
+                sender = recover_address(*key)
+            except InvalidSignature:
+                continue
+            signature_cache[key] = sender
+            recovered += 1
+        for obj in objs:
+            obj._sender = sender
+    return recovered
+
+
+def raw_signature_keys(sedes, data):
+    """
+    returns the (rawhash, v, r, s) of all signed messages in data, which is rlp decoded
+    without sedes. this allows to verify signatures before the messages are deserialized.
+    """
+    keys = []
+    if sedes in (Block, TransientBlock):
+        pass  # w/o signed messages, the txs are not walked
+    elif isinstance(sedes, CountableList):
+        for item in data:
+            keys.extend(raw_signature_keys(sedes.element_sedes, item))
+    elif isinstance(sedes, List):
+        for s, item in zip(sedes, data):
+            keys.extend(raw_signature_keys(s, item))
+    elif isinstance(sedes, type) and issubclass(sedes, rlp.Serializable):
+        for (_, s), item in zip(sedes.fields, data):
+            keys.extend(raw_signature_keys(s, item))
+        if issubclass(sedes, Signed):
+            assert len(data) == len(sedes.fields)
+            v, r, s = [big_endian_to_int(x) for x in data[-3:]]
+            if v:
+                keys.append((sha3(rlp.encode(data[:-3])), v, r, s))
+    return keys
+
+
+# aggregated locksets
+# works on rlp decoded data, i.e. w/o deserializing the votes
+
+
+def aggregate_lockset(data, ref_votes=None):
+    """
+    [num_eligible_votes, votes] > [num_eligible_votes, height, round, blockhashes, votes]
+    votes are [blockhash index (0 for VoteNil), v, r, s] or the index of the same vote
+    in ref_votes.
+    """
+    num_eligible_votes, votes = data
+    if not votes:
+        return [num_eligible_votes, '', '', [], []]
+    height, round = votes[0][:2]
+    refs = dict((rlp.codec.encode_raw(v), i) for i, v in enumerate(ref_votes or []))
+    blockhashes = sorted(set(v[2] for v in votes if v[2]))
+    aggregated = []
+    for vote in votes:
+        assert vote[:2] == [height, round]
+        i = refs.get(rlp.codec.encode_raw(vote))
+        if i is not None:
+            aggregated.append(big_endian_int.serialize(i))
+        else:
+            bh_index = blockhashes.index(vote[2]) + 1 if vote[2] else 0
+            aggregated.append([big_endian_int.serialize(bh_index)] + vote[3:])
+    return [num_eligible_votes, height, round, blockhashes, aggregated]
+
+
+def expand_lockset(data, ref_votes=None):
+    "inverse of aggregate_lockset"
+    num_eligible_votes, height, round, blockhashes, aggregated = data
+    votes = []
+    for vote in aggregated:
+        if not isinstance(vote, list):
+            votes.append(ref_votes[big_endian_to_int(vote)])
+        else:
+            bh_index = big_endian_to_int(vote[0])
+            blockhash = blockhashes[bh_index - 1] if bh_index else ''
+            votes.append([height, round, blockhash] + vote[1:])
+    return [num_eligible_votes, votes]
+
+
+def map_locksets(sedes, data, f):
+    "replaces the rlp decoded locksets in data with f(lockset)"
+    if sedes is LockSet:
+        return f(data)
+    elif isinstance(sedes, CountableList):
+        return [map_locksets(sedes.element_sedes, item, f) for item in data]
+    elif isinstance(sedes, List):
+        return [map_locksets(s, item, f) for s, item in zip(sedes, data)]
+    elif isinstance(sedes, type) and issubclass(sedes, rlp.Serializable):
+        return [map_locksets(s, item, f) for (_, s), item in zip(sedes.fields, data)]
+    return data
+
+
 def genesis_signing_lockset(genesis, privkey):
     """
     in order to avoid a complicated bootstrapping, we define
@@ -432,7 +687,7 @@ class BlockProposal(Proposal):
         if self.round_lockset and not round_lockset.has_noquorum:
             raise InvalidProposalError('at R>0 can only propose if there is a NoQuorum for R-1')
 
-        self.rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
+        self._initial_rawhash = self.rawhash
         if self.v:  # validate sender == block.coinbase
             assert self.sender
 
@@ -446,10 +701,9 @@ class BlockProposal(Proposal):
         s = super(BlockProposal, self).sender
         if not s:
             raise InvalidProposalError('signature missing')
-        assert self.rawhash
         assert self.v
-        _rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
-        assert self.rawhash == _rawhash
+        if self.is_mutable():  # frozen instances can not have changed
+            assert self.rawhash == self._initial_rawhash
         assert len(s) == 20
         assert len(self.block.header.coinbase) == 20
         if s != self.block.header.coinbase:
@@ -486,6 +740,56 @@ class BlockProposal(Proposal):
         return self.block.hash
 
 
+class CompactBlockProposal(rlp.Serializable):
+
+    """
+    A BlockProposal which refers to the transactions of its block by short ids.
+    Announced instead of large proposals, receivers rebuild the proposal from the
+    transactions they know. The signature can only be verified on the rebuilt proposal.
+
+    The ids are salted with the blockhash, so colliding txs can not be made up
+    before the block is known.
+    """
+    short_id_size = 8
+
+    fields = [
+        ('height', big_endian_int),
+        ('round', big_endian_int),
+        ('header', HDCBlockHeader),
+        ('transaction_ids', CountableList(binary)),
+        ('uncles', CountableList(BlockHeader)),
+        ('signing_lockset', LockSet),
+        ('round_lockset', LockSet)
+    ] + Signed.fields
+
+    @classmethod
+    def short_ids(cls, blockhash, tx_hashes):
+        return [sha3(blockhash + h)[:cls.short_id_size] for h in tx_hashes]
+
+    @classmethod
+    def from_proposal(cls, p):
+        assert isinstance(p, BlockProposal)
+        tx_ids = cls.short_ids(p.blockhash, [tx.hash for tx in p.block.transaction_list])
+        return cls(p.height, p.round, p.block.header, tx_ids, p.block.uncles,
+                   p.signing_lockset, p.round_lockset, p.v, p.r, p.s)
+
+    def to_proposal(self, transactions):
+        "raises InvalidProposalError if the transactions don't match the signed block"
+        assert len(transactions) == len(self.transaction_ids)
+        block = TransientBlock(self.header, transactions, self.uncles)
+        return BlockProposal(self.height, self.round, block, self.signing_lockset,
+                             self.round_lockset or None, self.v, self.r, self.s)
+
+    @property
+    def blockhash(self):
+        return self.header.hash
+
+    def __repr__(self):
+        return "<%s H:%d R:%d BH:%s txs:%d>" % (self.__class__.__name__, self.height,
+                                                self.round, phx(self.blockhash),
+                                                len(self.transaction_ids))
+
+
 class VotingInstruction(Proposal):
 
     fields = [
@@ -4,9 +4,11 @@ import rlp
 from .base import LockSet, Vote, VoteBlock, VoteNil, Signed, Ready
 from .base import BlockProposal, VotingInstruction, DoubleVotingError, InvalidVoteError
 from .base import TransientBlock, Block, Proposal, HDCBlockHeader, InvalidProposalError
+from .base import signed_objects, recover_senders
 from .protocol import HDCProtocol
 from .utils import cstr, phx
 from .synchronizer import Synchronizer
+from .store import ProposalStore
 from ethereum.slogging import get_logger
 log = get_logger('hdc.consensus')
 
@@ -84,7 +86,6 @@ class ConsensusManager(object):
     num_initial_blocks = 10
     round_timeout = 3  # timeout when waiting for proposal
     round_timeout_factor = 1.5  # timeout increase per round
-    transaction_timeout = 0.5  # delay when waiting for new transaction
 
     def __init__(self, chainservice, consensus_contract, privkey):
         self.chainservice = chainservice
@@ -92,9 +93,13 @@ class ConsensusManager(object):
         self.contract = consensus_contract
         self.privkey = privkey
 
+        self.store = ProposalStore(chainservice.db)
         self.synchronizer = Synchronizer(self)
         self.heights = ManagerDict(HeightManager, self)
         self.block_candidates = dict()  # blockhash : BlockProposal
+        self.timeout_alarm = None
+        self.transaction_alarm = None
+        self.batch_alarm = None
 
         self.tracked_protocol_failures = list()
 
@@ -114,8 +119,8 @@ class ConsensusManager(object):
         self.add_vote(v)
 
         # add initial lockset
-        head_proposal = self.load_proposal(self.head.hash)
-        #assert head_proposal
+        head_proposal = self.store.load_proposal(self.head.number) or \
+            self.load_proposal(self.head.hash)
         if head_proposal:
             assert head_proposal.blockhash == self.head.hash
             for v in head_proposal.signing_lockset:
@@ -133,32 +138,16 @@ class ConsensusManager(object):
         assert self.last_committing_lockset
         assert self.last_valid_lockset
 
-    # persist proposals and last committing lockset
-
-    def store_last_committing_lockset(self, ls):
-        assert isinstance(ls, LockSet)
-        assert ls.has_quorum
-        self.chainservice.db.put('last_committing_lockset', rlp.encode(ls))
+    # persist proposals and committing locksets
 
     def load_last_committing_lockset(self):
-        try:
-            data = self.chainservice.db.get('last_committing_lockset')
-        except KeyError:
+        ls = self.store.load_lockset(self.head.number)
+        if not ls:
             self.log('no last_committing_lockset could be loaded')
-            return
-        return rlp.decode(data, sedes=LockSet)
+        return ls
 
-    def store_proposal(self, p):
-        assert isinstance(p, BlockProposal)
-        self.chainservice.db.put('blockproposal:%s' % p.blockhash, rlp.encode(p))
-
-    def load_proposal_rlp(self, blockhash):
-        try:
-            prlp = self.chainservice.db.get('blockproposal:%s' % blockhash)
-            assert isinstance(prlp, bytes)
-            return prlp
-        except KeyError:
-            return None
+    def load_proposal_rlp(self, blockhash, aggregated=False):
+        return self.store.load_proposal_rlp_by_blockhash(blockhash, aggregated)
 
     def load_proposal(self, blockhash):
         prlp = self.load_proposal_rlp(blockhash)
@@ -171,10 +160,37 @@ class ConsensusManager(object):
     def has_blockproposal(self, blockhash):
         return bool(self.load_proposal_rlp(blockhash))
 
-    def get_blockproposal_rlp_by_height(self, height):
+    def get_blockproposal_rlp_by_height(self, height, aggregated=False):
         assert 0 < height < self.height
-        bh = self.chainservice.chain.index.get_block_by_number(height)
-        return self.load_proposal_rlp(bh)
+        prlp = self.store.load_proposal_rlp(height, aggregated)
+        if prlp is None:  # old db
+            bh = self.chainservice.chain.index.get_block_by_number(height)
+            prlp = self.load_proposal_rlp(bh, aggregated)
+        return prlp
+
+    def get_blockproposals_rlp(self, heights, max_bytes):
+        """
+        rlp of the committed proposals at heights, at least one and up to max_bytes,
+        w/ aggregated locksets as sent on the wire
+        """
+        heights = [h for h in heights if 0 < h < self.height]
+        if heights and heights[-1] - heights[0] == len(heights) - 1:  # range
+            stored = dict(self.store.iter_proposals_rlp(heights[0], heights[-1] + 1,
+                                                        aggregated=True))
+        else:
+            stored = dict()
+        found = []
+        size = 0
+        for height in heights:
+            prlp = stored.get(height) or \
+                self.get_blockproposal_rlp_by_height(height, aggregated=True)
+            if prlp is None:
+                break
+            size += len(prlp)
+            if found and size > max_bytes:
+                break
+            found.append(prlp)
+        return found
 
     @property
     def coinbase(self):
@@ -267,6 +283,7 @@ class ConsensusManager(object):
         if p.height < self.height:
             self.log('proposal from the past')
             return
+        recover_senders(signed_objects(p))
 
         if not check(self.contract.isvalidator(p.sender) and self.contract.isproposer(p)):
             return
@@ -306,6 +323,7 @@ class ConsensusManager(object):
             p._mutable = True
             p._cached_rlp = None
             p.block = blk  # block linked to chain
+            p._mutable = False
             self.log('successfully linked block')
             self.add_block_proposal(p)  # implicitly checks the votes validity
         else:
@@ -372,14 +390,29 @@ class ConsensusManager(object):
         ar = self.active_round
         delay = ar.get_timeout()
         self.log('in set up alarm', delay=delay)
+        alarm = self.timeout_alarm
+        if alarm is not None and (alarm.args[0] is not ar or delay is not None):
+            alarm.cancel()  # of a previous round or replaced
+            self.timeout_alarm = None
+        alarm = self.transaction_alarm
+        if alarm is not None and alarm.args[0] is not ar:
+            alarm.cancel()
+            self.transaction_alarm = None
+        if self.batch_alarm is not None:
+            self.batch_alarm.cancel()  # replaced
+            self.batch_alarm = None
         if self.is_waiting_for_proposal:
             if delay is not None:
-                self.chainservice.setup_alarm(delay, self.on_alarm, ar)
+                self.timeout_alarm = self.chainservice.setup_alarm(delay, self.on_alarm, ar)
                 self.log('set up alarm on timeout', now=self.chainservice.now,
                          delay=delay, triggered=delay + self.chainservice.now)
         else:
-            self.chainservice.setup_transaction_alarm(self.on_alarm, ar)
+            self.transaction_alarm = self.chainservice.setup_transaction_alarm(self.on_alarm, ar)
             self.log('set up alarm on tx', now=self.chainservice.now)
+            batch_delay = self.chainservice.batch_delay()
+            if batch_delay:  # pending txs are held back
+                self.batch_alarm = self.chainservice.setup_alarm(batch_delay, self.on_alarm, ar)
+                self.log('set up alarm on batch', delay=batch_delay)
 
     def on_alarm(self, ar):
         assert isinstance(ar, RoundManager)
@@ -400,12 +433,12 @@ class ConsensusManager(object):
     @property
     def is_waiting_for_proposal(self):
         return self.allow_empty_blocks \
-            or self.has_pending_transactions \
+            or self.chainservice.batch_delay() == 0 \
             or self.height <= self.num_initial_blocks
 
     @property
     def has_pending_transactions(self):
-        return self.chain.head_candidate.num_transactions() > 0
+        return len(self.chainservice.txpool) > 0
 
     def process(self):
         h = self.height
@@ -419,10 +452,11 @@ class ConsensusManager(object):
             self.log('not ready ')
             self.setup_alarm()
             return
+        self.synchronizer.add_proposals()
         self.commit()
         self.heights[self.height].process()
-        if self.commit():  # re enter process if we did commit (e.g. to immediately propose)
-            return self._process()
+        while self.commit():  # process the new height if we did commit (e.g. to propose)
+            self.heights[self.height].process()
         self.cleanup()
         self.synchronizer.process()
         self.setup_alarm()
@@ -434,26 +468,34 @@ class ConsensusManager(object):
     start = process
 
     def commit(self):
+        "commits all possible, returns True if any block was committed"
         self.log('in commit')
+        committed = False
+        while self.commit_next():
+            committed = True
+        return committed
+
+    def commit_next(self):
         for p in [c for c in self.block_candidates.values() if c.block.prevhash == self.head.hash]:
             assert isinstance(p, BlockProposal)
             ls = self.heights[p.height].last_quorum_lockset
             if ls and ls.has_quorum == p.blockhash:
-                self.store_proposal(p)
-                self.store_last_committing_lockset(ls)
+                self.store.stage(p, ls)  # committed together with the block
                 success = self.chainservice.commit_block(p.block)
                 assert success
                 if success:
+                    self.store.commit()
                     self.log('commited', p=p, hash=phx(p.blockhash))
                     assert self.head == p.block
-                    self.commit()  # commit all possible
                     return True
                 else:
+                    self.store.revert()
                     self.log('could not commit', p=p)
             else:
                 self.log('no quorum for', p=p)
                 if ls:
                     self.log('votes', votes=ls.votes)
+        return False
 
     def cleanup(self):
         self.log('in cleanup')
@@ -632,7 +674,7 @@ class RoundManager(object):
         assert signing_lockset.has_quorum
         # for R0 (std case) we only need one lockset!
         assert round_lockset is None or self.round > 0
-        block = self.cm.chain.head_candidate
+        block = self.cm.chainservice.build_block()  # w/ the pooled txs
         # fix pow
         block.header.__class__ = HDCBlockHeader
         block.should_be_locked = True
@@ -2,8 +2,13 @@ import rlp
 import gevent
 import time
 from devp2p.protocol import BaseProtocol, SubProtocolError
+from devp2p.multiplexer import Packet
 from ethereum.transactions import Transaction
 from hydrachain.consensus.base import BlockProposal, VotingInstruction, Vote, LockSet, Ready
+from hydrachain.consensus.base import CompactBlockProposal
+from hydrachain.consensus.base import raw_signature_keys, map_locksets
+from hydrachain.consensus.base import aggregate_lockset, expand_lockset
+from hydrachain.utils import LRUCache
 from ethereum import slogging
 log = slogging.get_logger('protocol.hdc')
 
@@ -12,6 +17,60 @@ class HDCProtocolError(SubProtocolError):
     pass
 
 
+class DecodedPayload(bytes):
+
+    "a payload carrying its rlp decoded data, so it is not decoded twice"
+
+    def __new__(cls, payload, sedes, data):
+        self = super(DecodedPayload, cls).__new__(cls, payload)
+        self.sedes, self.data = sedes, data
+        return self
+
+
+class HDCCommand(BaseProtocol.command):
+
+    """
+    LockSets are sent aggregated (since version 2): height, round and the distinct
+    blockhashes once, the votes as signatures with an index into the blockhashes.
+    They are decoded to the usual LockSets.
+    """
+
+    signed = False  # carries votes or locksets, see HDCProtocol.receive_packet
+
+    @classmethod
+    def get_sedes(cls):
+        if isinstance(cls.structure, rlp.sedes.CountableList):
+            return cls.structure
+        return rlp.sedes.List([x[1] for x in cls.structure], strict=cls.decode_strict)
+
+    @classmethod
+    def encode_payload(cls, data):
+        if isinstance(data, dict):  # convert dict to ordered list
+            assert isinstance(cls.structure, list)
+            data = [data[x[0]] for x in cls.structure]
+        if isinstance(cls.structure, list):
+            assert len(data) == len(cls.structure)
+        sedes = cls.get_sedes()
+        return rlp.codec.encode_raw(map_locksets(sedes, sedes.serialize(data), aggregate_lockset))
+
+    @classmethod
+    def decode_raw_payload(cls, rlp_data):
+        "returns the sedes and the rlp decoded payload with expanded locksets"
+        if isinstance(rlp_data, DecodedPayload):
+            return rlp_data.sedes, rlp_data.data
+        sedes = cls.get_sedes()
+        return sedes, map_locksets(sedes, rlp.decode(str(rlp_data)), expand_lockset)
+
+    @classmethod
+    def decode_payload(cls, rlp_data):
+        sedes, data = cls.decode_raw_payload(rlp_data)
+        data = sedes.deserialize(data)
+        if isinstance(cls.structure, rlp.sedes.CountableList):
+            return data
+        else:  # convert to dict
+            return dict((cls.structure[i][0], v) for i, v in enumerate(data))
+
+
 class HDCProtocol(BaseProtocol):
 
     """
@@ -21,15 +80,52 @@ class HDCProtocol(BaseProtocol):
     network_id = 0
     max_cmd_id = 15  # FIXME
     name = 'hdc'
-    version = 1
-    max_getproposals_count = 10
+    version = 2  # 2: aggregated locksets, compact proposals
+    max_getproposals_count = 10  # requested until a peer is known to serve more
+    max_blockproposals_count = 128  # max served by this version
+    max_blockproposals_bytes = 2 * 1024 ** 2
+    max_known_transactions = 4096
 
     def __init__(self, peer, service):
         # required by P2PProtocol
         self.config = peer.config
+        self.known_transactions = LRUCache(self.max_known_transactions)
+        self.packet_size = 0  # of the payload being received, as sent over the wire
         BaseProtocol.__init__(self, peer, service)
 
-    class status(BaseProtocol.command):
+    def mark_known_transactions(self, transactions):
+        "remember txs the peer has, so they are not sent to it"
+        for tx in transactions:
+            self.known_transactions[tx.hash] = True
+
+    def send_new_transactions(self, *transactions):
+        "sends the txs which are not known by the peer"
+        transactions = [tx for tx in transactions if tx.hash not in self.known_transactions]
+        if transactions:
+            self.mark_known_transactions(transactions)
+            self.send_transactions(*transactions)
+
+    def receive_packet(self, packet):
+        """
+        if the service has verification workers, the signatures of votes and locksets
+        in the packet are recovered there, before the payload is deserialized (which
+        requires the senders). the decoded payload is passed on to the command.
+        """
+        self.packet_size = len(packet.payload)
+        verifier = getattr(self.service, 'verifier', None)
+        klass = getattr(self.__class__, self.cmd_by_id.get(packet.cmd_id, ''), None)
+        if verifier and verifier.workers and klass is not None and klass.signed:
+            try:
+                sedes, data = klass.decode_raw_payload(packet.payload)
+            except (AssertionError, rlp.RLPException, TypeError, ValueError):
+                pass  # malformed, left to decode_payload
+            else:
+                verifier.prefetch(raw_signature_keys(sedes, data))
+                packet = Packet(packet.protocol_id, packet.cmd_id,
+                                DecodedPayload(packet.payload, sedes, data), packet.prioritize)
+        BaseProtocol.receive_packet(self, packet)
+
+    class status(HDCCommand):
 
         """
         protocolVersion: The version of the HydraChain protocol this peer implements.
@@ -38,6 +134,7 @@ class HDCProtocol(BaseProtocol):
         current_lockset: The lockset of the current round from the responding peer
         """
         cmd_id = 0
+        signed = True
         sent = False
 
         structure = [
@@ -52,7 +149,7 @@ class HDCProtocol(BaseProtocol):
             network_id = proto.service.app.config['eth'].get('network_id', proto.network_id)
             return [proto.version, network_id, genesis_hash, current_lockset]
 
-    class transactions(BaseProtocol.command):
+    class transactions(HDCCommand):
 
         """
         Specify (a) transaction(s) that the peer should make sure is included on its transaction
@@ -64,7 +161,9 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 1
         structure = rlp.sedes.CountableList(Transaction)
 
-        # todo: bloomfilter: so we don't send tx to the originating peer
+        def receive(self, proto, data):
+            proto.mark_known_transactions(data)
+            HDCCommand.receive(self, proto, data)
 
         @classmethod
         def decode_payload(cls, rlp_data):
@@ -76,7 +175,7 @@ class HDCProtocol(BaseProtocol):
                     gevent.sleep(0.0001)
             return txs
 
-    class getblockproposals(BaseProtocol.command):
+    class getblockproposals(HDCCommand):
 
         """
         Requests a BlockProposals message detailing a number of blocks to be sent, each referred to
@@ -86,47 +185,96 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 2
         structure = rlp.sedes.CountableList(rlp.sedes.big_endian_int)
 
-    class blockproposals(BaseProtocol.command):
+    class blockproposals(HDCCommand):
 
         """
-        BlockProposals sent in response to a getproposals request
+        BlockProposals sent in response to a getproposals request.
+        Peers may send less than requested: up to max_blockproposals_count proposals
+        within max_blockproposals_bytes, and only up to the first height they don't have.
         """
         cmd_id = 3
+        signed = True
         structure = rlp.sedes.CountableList(BlockProposal)
 
         @classmethod
         def encode_payload(cls, list_of_rlp):
             """
-            rlp data directly from the database
+            rlp data directly from the database w/ aggregated locksets,
+            concatenated w/o deserializing (see ProposalStore.load_proposal_rlp)
             """
             assert isinstance(list_of_rlp, tuple)
             assert not list_of_rlp or isinstance(list_of_rlp[0], bytes)
-            return rlp.encode([rlp.codec.RLPData(x) for x in list_of_rlp], infer_serializer=False)
+            payload = b''.join(list_of_rlp)
+            return rlp.codec.length_prefix(len(payload), 0xc0) + payload
 
-    class newblockproposal(BaseProtocol.command):
+    class newblockproposal(HDCCommand):
 
         """
         Specify a single BlockProposal that the peer should know about.
         """
         cmd_id = 4
+        signed = True
         structure = [('proposal', BlockProposal)]
 
-    class votinginstruction(BaseProtocol.command):
+    class votinginstruction(HDCCommand):
 
         """
         Specify a single VotingInstruction that the peer should know about.
         """
         cmd_id = 5
+        signed = True
         structure = [('votinginstruction', VotingInstruction)]
 
-    class vote(BaseProtocol.command):
+    class vote(HDCCommand):
 
         """
         Specify a single Vote that the peer should know about.
         """
         cmd_id = 6
+        signed = True
         structure = [('vote', Vote)]
 
-    class ready(BaseProtocol.command):
+    class ready(HDCCommand):
         cmd_id = 7
         structure = [('ready', Ready)]
+
+    class newcompactblockproposal(HDCCommand):
+
+        """
+        Announces a BlockProposal w/o the transactions of its block.
+        Peers request the transactions they don't know with getblocktransactions.
+        """
+        cmd_id = 8
+        signed = True
+        signed = True
+        structure = [('proposal', CompactBlockProposal)]
+
+    class getblockproposal(HDCCommand):
+
+        """
+        Requests the announced BlockProposal by its blockhash, sent as newblockproposal.
+        """
+        cmd_id = 9
+        structure = [('blockhash', rlp.sedes.binary)]
+
+    class getblocktransactions(HDCCommand):
+
+        """
+        Requests transactions of an announced BlockProposal by their index in the block.
+        """
+        cmd_id = 10
+        structure = [
+            ('blockhash', rlp.sedes.binary),
+            ('indexes', rlp.sedes.CountableList(rlp.sedes.big_endian_int))
+        ]
+
+    class blocktransactions(HDCCommand):
+
+        """
+        The requested transactions of an announced BlockProposal.
+        """
+        cmd_id = 11
+        structure = [
+            ('blockhash', rlp.sedes.binary),
+            ('transactions', rlp.sedes.CountableList(Transaction))
+        ]
@@ -11,8 +11,8 @@ from hydrachain.consensus.utils import num_colors, phx
 import tempfile
 from ethereum import slogging
 from hydrachain import hdc_service
+from hydrachain.alarms import Alarm
 from hydrachain.consensus import protocol as hdc_protocol
-from hydrachain.consensus.base import Block
 from hydrachain.consensus.manager import RoundManager, ConsensusManager
 from ethereum.utils import big_endian_to_int, sha3, privtoaddr
 import ethereum.keys
@@ -189,11 +189,13 @@ class SimChainService(ChainService):
 
     def setup_alarm(self, delay, cb, *args):
         assert self.simenv
+        alarm = Alarm(self.now + delay, cb, args)
 
         def _trigger():
             yield self.simenv.timeout(delay)
-            cb(*args)
+            alarm.fire()
         self.simenv.process(_trigger())
+        return alarm
 
     def on_receive_newblockproposal(self, proto, proposal):
 
@@ -350,13 +352,12 @@ class Network(object):
         # highest round seen (i.e. number of failed proposers)
         max_rounds = 0
         for c in cs:
-            blk = c.chain.head
-            while blk.number > 0:
-                p = c.load_proposal(blk.hash)
+            num_proposals = 0
+            for p in c.store.iter_proposals(1, c.head.number + 1):
+                assert p.blockhash == c.chain.index.get_block_by_number(p.height)
                 max_rounds = max(max_rounds, p.signing_lockset.round)
-                bh = c.chain.index.get_block_by_number(blk.number - 1)
-                blk = c.chain.get(bh)
-                assert isinstance(blk, Block)
+                num_proposals += 1
+            assert num_proposals == c.head.number
         max_rounds += 1
 
         # messages
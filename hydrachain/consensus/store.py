@@ -0,0 +1,150 @@
+import rlp
+from rlp.codec import RLPData, encode_raw
+from rlp.sedes import big_endian_int
+from ethereum.utils import big_endian_to_int
+from .base import BlockProposal, LockSet, aggregate_lockset, expand_lockset, map_locksets
+
+
+def is_list(data):
+    return ord(data[0]) >= 0xc0
+
+
+class ProposalStore(object):
+
+    """
+    Persists committed proposals and their committing locksets by height.
+
+    Heights are only appended. Entries are staged in the db before the block is added
+    to the chain, which commits them together with the block in one batch.
+
+    Entries are compact: proposals refer to the block stored by the chain, votes
+    are stored w/o their height and round, and votes of a signing lockset, which are
+    also in the stored committing lockset of the previous height, by their index there.
+    The full proposal rlp is rebuilt on demand, w/o deserializing, either w/ expanded
+    locksets or w/ aggregated ones as sent on the wire (see HDCCommand).
+    Dbs written by older versions (uncompacted, proposals by blockhash, a single last
+    committing lockset) are still read.
+    """
+
+    proposal_key = 'blockproposal_height:%d'
+    lockset_key = 'committing_lockset:%d'
+    blockhash_key = 'blockproposal:%s'
+    old_lockset_key = 'last_committing_lockset'
+
+    def __init__(self, db):
+        self.db = db
+        self.staged = []  # keys written, but not yet committed with a block
+
+    def __repr__(self):
+        return '<ProposalStore(staged=%d)>' % len(self.staged)
+
+    def _get(self, key):
+        try:
+            data = self.db.get(key)
+        except KeyError:
+            return None
+        assert isinstance(data, bytes)
+        return data
+
+    # writing
+
+    def stage(self, p, ls):
+        "stage the proposal and the lockset committing it"
+        assert isinstance(p, BlockProposal)
+        assert isinstance(ls, LockSet)
+        assert ls.has_quorum == p.blockhash
+        prev_ls = self._load_lockset_items(p.height - 1)
+        raw, raw_ls = rlp.decode(rlp.encode(p)), rlp.decode(rlp.encode(ls))
+        cp = [raw[0], raw[1], p.blockhash,
+              aggregate_lockset(raw[3], prev_ls[1] if prev_ls else None),
+              aggregate_lockset(raw[4])] + raw[5:]
+        items = [(self.proposal_key % p.height, encode_raw(cp)),
+                 (self.lockset_key % p.height, encode_raw(aggregate_lockset(raw_ls))),
+                 (self.blockhash_key % p.blockhash, rlp.encode(p.height))]
+        for key, value in items:
+            self.db.put(key, value)
+        self.staged.extend(key for key, _ in items)
+
+    def commit(self):
+        "called after the staged entries were committed with the block"
+        self.staged = []
+
+    def revert(self):
+        "called if the block could not be committed"
+        for key in self.staged:
+            self.db.delete(key)
+        self.staged = []
+
+    # reading
+
+    def height_by_blockhash(self, blockhash):
+        data = self._get(self.blockhash_key % blockhash)
+        if data is not None and not is_list(data):  # proposals are lists
+            return rlp.decode(data, big_endian_int)
+
+    def load_proposal_rlp(self, height, aggregated=False):
+        data = self._get(self.proposal_key % height)
+        if data is None or is_list(rlp.descend(data, 2)):  # uncompacted
+            return self._aggregate(data) if aggregated else data
+        height, round, blockhash, sls, rls, v, r, s = rlp.decode(data)
+        block = self._get(blockhash)  # stored by the chain
+        if block is None:
+            return None
+        if aggregated and not any(not isinstance(vote, list) for vote in sls[4]):
+            return encode_raw([height, round, RLPData(block), sls, rls, v, r, s])
+        prev_ls = self._load_lockset_items(big_endian_to_int(height) - 1)
+        ref_votes = prev_ls[1] if prev_ls else None
+        sls = expand_lockset(sls, ref_votes)
+        if aggregated:  # only the references to the previous lockset are resolved
+            items = [height, round, RLPData(block), aggregate_lockset(sls), rls, v, r, s]
+        else:
+            items = [height, round, RLPData(block), sls, expand_lockset(rls), v, r, s]
+        return encode_raw(items)
+
+    def _aggregate(self, data):
+        "proposal rlp of older versions w/ aggregated locksets"
+        if data is not None:
+            return encode_raw(map_locksets(BlockProposal, rlp.decode(data), aggregate_lockset))
+
+    def load_proposal_rlp_by_blockhash(self, blockhash, aggregated=False):
+        data = self._get(self.blockhash_key % blockhash)
+        if data is not None and not is_list(data):
+            return self.load_proposal_rlp(rlp.decode(data, big_endian_int), aggregated)
+        return self._aggregate(data) if aggregated else data  # stored by blockhash
+
+    def load_proposal(self, height):
+        data = self.load_proposal_rlp(height)
+        if data is not None:
+            return rlp.decode(data, sedes=BlockProposal)
+
+    def _load_lockset_items(self, height):
+        "rlp decoded committing lockset"
+        data = self._get(self.lockset_key % height)
+        if data is not None:
+            items = rlp.decode(data)
+            return items if len(items) == 2 else expand_lockset(items)  # uncompacted or not
+
+    def load_lockset(self, height):
+        "the lockset which committed the block at height"
+        items = self._load_lockset_items(height)
+        if items is not None:
+            return rlp.decode(encode_raw(items), sedes=LockSet)
+        data = self._get(self.old_lockset_key)
+        if data is not None:
+            ls = rlp.decode(data, sedes=LockSet)
+            if ls.height == height:
+                return ls
+
+    def iter_proposals_rlp(self, start, stop=None, aggregated=False):
+        "yields (height, rlp) of the stored proposals from start, up to the first gap or stop"
+        height = start
+        while stop is None or height < stop:
+            data = self.load_proposal_rlp(height, aggregated)
+            if data is None:
+                return
+            yield height, data
+            height += 1
+
+    def iter_proposals(self, start, stop=None):
+        for height, data in self.iter_proposals_rlp(start, stop):
+            yield rlp.decode(data, sedes=BlockProposal)
@@ -1,18 +1,127 @@
+import itertools
 import gevent
-from .base import Proposal
+import gevent.lock
+from .base import Proposal, InvalidProposalError, signed_objects, recover_senders
+from .base import InvalidSignature, MissingSignatureError, InvalidVoteError
 from .protocol import HDCProtocol
 
 
+class SyncPeer(object):
+
+    """
+    sync state and stats of a peer
+
+    the round trip times of getblockproposals requests are tracked like in TCP,
+    the timeout is srtt + 4 * rttvar and doubles with every timeout in a row.
+    """
+
+    rate_smoothing = 0.5  # weight of the last measurement
+    rtt_smoothing = 0.125
+    rttvar_smoothing = 0.25
+    min_timeout = 0.5
+    max_timeout = 30.
+
+    def __init__(self, proto, default_timeout=5.):
+        self.proto = proto
+        self.default_timeout = default_timeout
+        self.inflight = 0  # number of pending requests
+        self.rate = None  # measured proposals / sec
+        self.srtt = None  # smoothed round trip time
+        self.rttvar = None
+        self.bytes_per_proposal = None
+        self.backoff = 1  # doubled on timeouts
+        self.failures = 0
+        self.num_received = 0
+        self.bytes_received = 0
+        # requests are limited to what all peers serve, and raised while responses are complete
+        self.max_count = HDCProtocol.max_getproposals_count
+
+    def __repr__(self):
+        return '<SyncPeer(%r inflight=%d rate=%r)>' % (self.proto, self.inflight, self.rate)
+
+    @property
+    def is_active(self):
+        return not self.proto.is_stopped
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            timeout = self.default_timeout
+        else:
+            timeout = max(self.min_timeout, self.srtt + 4 * self.rttvar)
+        return min(self.max_timeout, timeout * self.backoff)
+
+    def batch_size(self, max_count, target_time):
+        "number of proposals we expect the peer to deliver within target_time"
+        max_count = min(max_count, self.max_count)
+        if self.rate is None:
+            return max_count
+        return max(1, min(max_count, int(self.rate * target_time)))
+
+    def smooth(self, value, new, weight):
+        return new if value is None else weight * new + (1 - weight) * value
+
+    def on_response(self, num, elapsed, num_bytes=0, num_requested=0):
+        if num_requested and num == num_requested:
+            self.max_count = min(2 * self.max_count, HDCProtocol.max_blockproposals_count)
+        elif num_requested:  # truncated by the peer
+            self.max_count = max(num, HDCProtocol.max_getproposals_count)
+        elapsed = max(elapsed, 0.001)
+        self.rate = self.smooth(self.rate, num / elapsed, self.rate_smoothing)
+        if self.srtt is None:
+            self.srtt, self.rttvar = elapsed, elapsed / 2
+        else:
+            self.rttvar = self.smooth(self.rttvar, abs(self.srtt - elapsed),
+                                      self.rttvar_smoothing)
+            self.srtt = self.smooth(self.srtt, elapsed, self.rtt_smoothing)
+        if num:
+            self.backoff = 1
+            self.num_received += num
+            self.bytes_received += num_bytes
+            self.bytes_per_proposal = self.smooth(self.bytes_per_proposal, num_bytes / num,
+                                                  self.rate_smoothing)
+
+    def on_timeout(self):
+        self.failures += 1
+        self.rate = self.smooth(self.rate, 0, self.rate_smoothing)
+        self.backoff = min(self.backoff * 2, 64)
+
+    @property
+    def stats(self):
+        return dict(inflight=self.inflight, max_count=self.max_count, rate=self.rate,
+                    srtt=self.srtt, rttvar=self.rttvar, timeout=self.timeout,
+                    bytes_per_proposal=self.bytes_per_proposal,
+                    num_received=self.num_received, bytes_received=self.bytes_received,
+                    failures=self.failures)
+
+
 class Synchronizer(object):
 
-    timeout = 5
-    max_getproposals_count = HDCProtocol.max_getproposals_count
-    max_queued = 3 * max_getproposals_count
+    """
+    Syncs the missing proposals from the synced peers.
+
+    In parallel mode the missing heights are spread over all peers which sent valid
+    proposals, with up to max_inflight_per_peer requests each. The batch size per peer
+    follows its measured throughput. Ranges of timed out requests are rerequested,
+    preferably from other peers. Proposals are added in order of their height.
+    """
+
+    timeout = 5  # until the round trip time of a peer is known
+    parallel = True
+    max_inflight_per_peer = 2
+    target_request_time = 1.  # batches should be delivered within this time
+    max_getproposals_count = HDCProtocol.max_blockproposals_count
+    max_queued = 10 * HDCProtocol.max_getproposals_count  # min number of heights requested ahead
 
     def __init__(self, consensusmanager):
         self.cm = consensusmanager
         self.requested = set()
         self.received = set()
+        self.proposals = dict()  # height: received, not yet added proposal
+        self.requests = dict()  # request_id: (peer, blocknumbers, time sent)
+        self.alarms = dict()  # request_id: timeout alarm
+        self.peers = dict()  # proto: SyncPeer
+        self.request_ids = itertools.count()
         self.last_active_protocol = None  # last protocol (peer) which sent a proposal
         self.add_proposals_lock = gevent.lock.Semaphore()
 
@@ -35,6 +144,26 @@ class Synchronizer(object):
             return []
         return range(self.cm.head.number + 1, max_height + 1)
 
+    def sync_peers(self):
+        "peers to request from, fastest first"
+        if not self.parallel:
+            proto = self.last_active_protocol
+            return [self.peers[proto]] if proto in self.peers else []
+        for proto, peer in self.peers.items():
+            if not peer.is_active:
+                del self.peers[proto]
+        return sorted(self.peers.values(), key=lambda p: -1 if p.rate is None else -p.rate)
+
+    @property
+    def peer_stats(self):
+        return dict((proto, peer.stats) for proto, peer in self.peers.items())
+
+    def queue_size(self, peers, max_inflight):
+        "number of heights requested ahead, so all peers can be kept busy"
+        size = sum(max_inflight * p.batch_size(self.max_getproposals_count,
+                                               self.target_request_time) for p in peers)
+        return max(self.max_queued, size)
+
     def request(self):
         """
         sync the missing blocks between:
@@ -46,34 +175,42 @@ class Synchronizer(object):
         missing = self.missing
         self.cm.log('sync.request', missing=len(missing), requested=len(self.requested),
                     received=len(self.received))
-        if self.requested:
-            self.cm.log('waiting for requested')
-            return
-        if len(self.received) + self.max_getproposals_count >= self.max_queued:
-            self.cm.log('queue is full')
-            return
         if not missing:
             self.cm.log('insync')
             return
-        if self.last_active_protocol is None:  # FIXME, check if it is active
+        peers = self.sync_peers()
+        if not peers:
             self.cm.log('no active protocol', last_active_protocol=self.last_active_protocol)
             return
-        self.cm.log('collecting')
-        blocknumbers = []
-        for h in missing:
-            if h not in self.received and h not in self.requested:
-                blocknumbers.append(h)
-                self.requested.add(h)
-                if len(blocknumbers) == self.max_getproposals_count:
-                    break
+        max_inflight = self.max_inflight_per_peer if self.parallel else 1
+        max_height = self.cm.head.number + self.queue_size(peers, max_inflight)
+        blocknumbers = [h for h in missing if h <= max_height and
+                        h not in self.received and h not in self.requested]
         self.cm.log('collected', num=len(blocknumbers))
-        if not blocknumbers:
-            return
-        self.cm.log('requesting', num=len(blocknumbers),
+        while blocknumbers:
+            free = [p for p in peers if p.inflight < max_inflight]
+            if not free:
+                self.cm.log('waiting for requested')
+                break
+            for peer in free:
+                count = peer.batch_size(self.max_getproposals_count, self.target_request_time)
+                batch, blocknumbers = blocknumbers[:count], blocknumbers[count:]
+                self.send_request(peer, batch)
+                if not blocknumbers:
+                    break
+
+    def send_request(self, peer, blocknumbers):
+        self.cm.log('requesting', num=len(blocknumbers), peer=peer.proto,
                     requesting_range=(blocknumbers[0], blocknumbers[-1]))
-        self.last_active_protocol.send_getblockproposals(*blocknumbers)
+        request_id = next(self.request_ids)
+        self.requests[request_id] = (peer, blocknumbers, self.cm.chainservice.now)
+        self.requested.update(blocknumbers)
+        peer.inflight += 1
+        peer.proto.send_getblockproposals(*blocknumbers)
         # setup alarm
-        self.cm.chainservice.setup_alarm(self.timeout, self.on_alarm, blocknumbers)
+        alarm = self.cm.chainservice.setup_alarm(peer.timeout, self.on_alarm, request_id)
+        if alarm is not None:
+            self.alarms[request_id] = alarm
 
     def on_proposal(self, proposal, proto):
         "called to inform about synced peers"
@@ -82,50 +219,73 @@ class Synchronizer(object):
         if proposal.height >= self.cm.height:
             assert proposal.lockset.is_valid
             self.last_active_protocol = proto
+            if proto not in self.peers:
+                self.peers[proto] = SyncPeer(proto, self.timeout)
 
-    def on_alarm(self, requested):
+    def on_alarm(self, request_id):
+        self.alarms.pop(request_id, None)
+        if request_id not in self.requests:
+            return  # answered
+        peer, blocknumbers, _ = self.requests.pop(request_id)
+        self.cm.log('sync request timed out', peer=peer.proto, num=len(blocknumbers))
+        peer.inflight -= 1
+        peer.on_timeout()
         # remove requested, so they can be rerequested
-        self.requested.difference_update(set(self.requested))
+        self.requested.difference_update(blocknumbers)
         self.request()
 
-    def receive_blockproposals(self, proposals):
+    def on_response(self, proto, proposals, num_bytes=0):
+        "finds the request answered by proposals and releases the heights not delivered"
+        heights = set(p.height for p in proposals)
+        for request_id, (peer, blocknumbers, sent_at) in self.requests.items():
+            if peer.proto == proto and heights.issubset(blocknumbers):
+                del self.requests[request_id]
+                if request_id in self.alarms:
+                    self.alarms.pop(request_id).cancel()
+                peer.inflight -= 1
+                peer.on_response(len(proposals), self.cm.chainservice.now - sent_at, num_bytes,
+                                 num_requested=len(blocknumbers))
+                self.requested.difference_update(blocknumbers)
+                return
+
+    def receive_blockproposals(self, proposals, proto=None, num_bytes=0):
+        "num_bytes is the size of the received packet"
         self.cm.log('receive_blockproposals', p=proposals, received=self.received)
+        recover_senders(signed_objects(*proposals))
+        if proto is not None:
+            self.on_response(proto, proposals, num_bytes)
         for p in proposals:
-            self.received.add(p.height)
-            self.requested.remove(p.height)
+            self.requested.discard(p.height)
+            if p.height > self.cm.head.number:
+                self.received.add(p.height)
+                self.proposals[p.height] = p
             for v in p.signing_lockset:  # add all votes, so we have locksets ready for committing
                 self.cm.add_vote(v)
 
-        # commit after we added new votes to commit a block from the last sync
-        self.cm.process()
-
-        # request next round
+        # request next batches
         self.request()
-        self.add_proposals_lock.acquire()
-        for p in proposals:
-            self.cm.add_proposal(p)
-            self.cm.process()
-        self.cleanup()
-        self.add_proposals_lock.release()
-
-        not_added = []
-        for p in proposals:
-            if p.height > self.cm.head.number:
-                not_added.append(p)
-                if p.height == self.cm.head.number:
-                    assert p.blockhash in self.cm.block_candidates
-
-        # print 'not added', not_added
-        # print 'received', self.received
-        # for h in self.cm.heights:
-        #     if self.cm.heights[h].last_quorum_lockset:
-        #         print 'quorum @', h
-
-        assert self.cm.height >= max(p.height for p in proposals)
-
+        # the proposals are added and committed by the consensus pass, see add_proposals
+        self.cm.chainservice.process_consensus()
         self.cm.log('done receive_blockproposals', sync=self)
-        if len(not_added) > 1:
-            raise Exception('more than one proposal not added')
+
+    def add_proposals(self):
+        """
+        adds the received proposals in order, as long as there are no gaps.
+        called by the consensus pass, committing each proposal w/ the votes of the next one.
+        """
+        with self.add_proposals_lock:
+            for h in sorted(self.proposals):
+                if h > self.cm.height:
+                    break
+                try:
+                    self.cm.add_proposal(self.proposals.pop(h))
+                except (InvalidProposalError, InvalidSignature, MissingSignatureError,
+                        InvalidVoteError) as e:
+                    self.cm.log('invalid proposal received', height=h, error=e)
+                    self.received.discard(h)  # rerequest
+                    break
+                self.cm.commit()
+            self.cleanup()
 
     def cleanup(self):
         height = self.cm.height
@@ -135,6 +295,9 @@ class Synchronizer(object):
         for h in list(self.requested):
             if h < height:
                 self.requested.remove(h)
+        for h in list(self.proposals):
+            if h < height:
+                del self.proposals[h]
 
     def process(self):
         self.request()
@@ -1,14 +1,17 @@
 import time
+import math
+import traceback
 from ethereum.config import Env
-from ethereum.utils import sha3
+from ethereum.utils import sha3, big_endian_to_int
 import rlp
 from rlp.utils import encode_hex
-from ethereum import processblock
+from ethereum import processblock, specials
 from ethereum.slogging import get_logger
 from ethereum.processblock import validate_transaction
 from ethereum.exceptions import InvalidTransaction
 from ethereum.chain import Chain
 from ethereum.refcount_db import RefcountDB
+from ethereum.trie import Trie, BLANK_ROOT
 from ethereum.blocks import Block, VerificationFailed
 from ethereum.transactions import Transaction
 from devp2p.service import WiredService
@@ -16,6 +19,7 @@ from devp2p.protocol import BaseProtocol
 from ethereum import config as ethereum_config
 import gevent
 import gevent.lock
+import gevent.event
 import statistics
 from collections import deque
 from gevent.queue import Queue
@@ -23,9 +27,17 @@ from pyethapp.eth_service import ChainService as eth_ChainService
 from .consensus.protocol import HDCProtocol, HDCProtocolError
 from .consensus.base import Signed, VotingInstruction, BlockProposal, Proposal, TransientBlock
 from .consensus.base import Vote, VoteBlock, VoteNil, HDCBlockHeader, LockSet, Ready
+from .consensus.base import CompactBlockProposal, InvalidProposalError, InvalidSignature
 from .consensus.utils import phx
 from .consensus.manager import ConsensusManager
 from .consensus.contract import ConsensusContract
+from .utils import LRUCache
+from .verifier import SignatureVerifier
+from .speculation import SpeculativeExecutor
+from .txpool import TransactionPool
+from .builder import BlockBuilder
+from .batching import BatchingPolicy
+from .alarms import AlarmScheduler, EventAlarms
 
 
 log = get_logger('hdc.chainservice')
@@ -47,25 +59,140 @@ def apply_transaction(block, tx):
 rlp_hash_hex = lambda data: encode_hex(sha3(rlp.encode(data)))
 
 
+hdc_default_config = dict(validators=[],
+                          # capacity of the filter for already received / broadcasted messages
+                          broadcast_filter_max_items=1024,
+                          # if > 0 use a rotating pair of bloom filters with this fp rate
+                          broadcast_filter_fp_rate=0,
+                          # number of processes recovering signatures, 0 to recover inline
+                          verify_workers=0,
+                          # window in secs in which outgoing txs are collected, 0 to send asap
+                          tx_broadcast_delay=0.05,
+                          # proposals of at least this size (bytes) are announced compact,
+                          # peers rebuild or request them. 0 to always send them in full
+                          compact_proposal_min_size=16 * 1024,
+                          # secs after which a requested proposal is requested from other peers
+                          proposal_request_timeout=2.,
+                          # max number of blocks built for the next proposer, 0 to disable
+                          speculative_candidates=2,
+                          # max number of committed blocks not yet flushed to the db,
+                          # 0 to flush when the block is committed
+                          max_unflushed_blocks=16,
+                          # max number of pending txs, in total and per sender
+                          txpool_max_size=4096,
+                          txpool_max_per_sender=64,
+                          # budget of proposed blocks: gas used (0 for the block gas limit),
+                          # bytes of txs (0 for no limit), secs applying txs (below round_timeout)
+                          block_gas_target=0,
+                          block_max_size=1024 * 1024,
+                          block_build_time=1.,
+                          # pending txs are proposed once they reach batch_min_txs or
+                          # batch_min_gas (startgas), or after batch_window secs if no further
+                          # txs are expected, not before min_block_interval secs after the
+                          # last block. 0 to disable each
+                          batch_window=0,
+                          batch_min_txs=0,
+                          batch_min_gas=0,
+                          min_block_interval=0,
+                          )
+
+
 class DuplicatesFilter(object):
 
+    "remembers the max_items most recently seen items, lookups are counted as hits or misses"
+
     def __init__(self, max_items=1024):
         self.max_items = max_items
-        self.filter = list()
+        self.filter = LRUCache(max_items)
 
     def update(self, data):
         "returns True if unknown"
-        if data not in self.filter:
-            self.filter.append(data)
-            if len(self.filter) > self.max_items:
-                self.filter.pop(0)
-            return True
-        else:
-            self.filter.append(self.filter.pop(0))
+        if data in self:
+            return False
+        self.filter[data] = True
+        return True
+
+    def __contains__(self, v):
+        return self.filter.get(v) is not None
+
+    @property
+    def hits(self):
+        return self.filter.hits
+
+    @property
+    def misses(self):
+        return self.filter.misses
+
+    @property
+    def hit_rate(self):
+        return self.filter.hit_rate
+
+    def __repr__(self):
+        return '<%s(hits=%d misses=%d)>' % (self.__class__.__name__, self.hits, self.misses)
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, fp_rate):
+        assert 0 < fp_rate < 1
+        self.num_bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.num_items = 0
+
+    def _positions(self, data):
+        # double hashing, see Kirsch, Mitzenmacher: Less Hashing, Same Performance
+        h = sha3(data)
+        h1, h2 = big_endian_to_int(h[:8]), big_endian_to_int(h[8:16])
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, data):
+        for p in self._positions(data):
+            self.bits[p // 8] |= 1 << (p % 8)
+        self.num_items += 1
+
+    def __contains__(self, data):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self._positions(data))
+
+
+class BloomDuplicatesFilter(DuplicatesFilter):
+
+    """
+    rotating pair of bloom filters, remembers at least the max_items most recently added items.
+    constant memory, but unknown items are reported as known with probability ~2 * fp_rate.
+    """
+
+    def __init__(self, max_items=1024, fp_rate=0.001):
+        self.max_items = max_items
+        self.fp_rate = fp_rate
+        self.current = BloomFilter(max_items, fp_rate)
+        self.previous = BloomFilter(max_items, fp_rate)
+        self._hits = self._misses = 0
+
+    def update(self, data):
+        "returns True if unknown"
+        if data in self:
             return False
+        if self.current.num_items >= self.max_items:
+            self.previous = self.current
+            self.current = BloomFilter(self.max_items, self.fp_rate)
+        self.current.add(data)
+        return True
 
     def __contains__(self, v):
-        return v in self.filter
+        if v in self.current or v in self.previous:
+            self._hits += 1
+            return True
+        self._misses += 1
+        return False
+
+    hits = property(lambda self: self._hits)
+    misses = property(lambda self: self._misses)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
 
 
 def update_watcher(chainservice):
@@ -118,6 +245,18 @@ class ProposalLock(gevent.lock.BoundedSemaphore):
     __str__ = __repr__
 
 
+class HDCChain(Chain):
+
+    "the db commit of added blocks can be left to on_commit, see ChainService.schedule_flush"
+
+    on_commit = None
+
+    def commit(self):
+        if self.on_commit is None:
+            return super(HDCChain, self).commit()
+        self.on_commit()
+
+
 class ChainService(eth_ChainService):
 
     """
@@ -129,7 +268,7 @@ class ChainService(eth_ChainService):
                                    genesis='',
                                    pruning=-1,
                                    block=ethereum_config.default_config),
-                          hdc=dict(validators=[]),
+                          hdc=dict(hdc_default_config),
                           )
 
     # required by WiredService
@@ -142,12 +281,18 @@ class ChainService(eth_ChainService):
     config = None
     block_queue_size = 1024
     transaction_queue_size = 1024
+    recent_transactions_size = 4096  # broadcasted txs, used to rebuild compact proposals
+    announced_proposals_size = 16
     processed_gas = 0
     processed_elapsed = 0
+    unflushed_blocks = 0
 
     def __init__(self, app):
         self.config = app.config
         sce = self.config['eth']
+        shc = self.config['hdc']
+        for k, v in hdc_default_config.items():
+            shc.setdefault(k, v)
         if int(sce['pruning']) >= 0:
             self.db = RefcountDB(app.services.db)
             if "I am not pruning" in self.db.db:
@@ -180,7 +325,9 @@ class ChainService(eth_ChainService):
         log.info('initializing chain')
         coinbase = app.services.accounts.coinbase
         env = Env(self.db, sce['block'])
-        self.chain = Chain(env, new_head_cb=self._on_new_head, coinbase=coinbase)
+        self.chain = HDCChain(env, new_head_cb=self._on_new_head, coinbase=coinbase)
+        if shc['max_unflushed_blocks']:
+            self.chain.on_commit = self.schedule_flush
 
         log.info('chain at', number=self.chain.head.number)
         if 'genesis_hash' in sce:
@@ -191,9 +338,31 @@ class ChainService(eth_ChainService):
         self.transaction_queue = Queue(maxsize=self.transaction_queue_size)
         self.add_blocks_lock = False
         self.add_transaction_lock = gevent.lock.BoundedSemaphore()
-        self.broadcast_filter = DuplicatesFilter()
+        if shc['broadcast_filter_fp_rate']:
+            self.broadcast_filter = BloomDuplicatesFilter(shc['broadcast_filter_max_items'],
+                                                          shc['broadcast_filter_fp_rate'])
+        else:
+            self.broadcast_filter = DuplicatesFilter(shc['broadcast_filter_max_items'])
+        self.verifier = SignatureVerifier(shc['verify_workers'])
+        self.speculative = SpeculativeExecutor(shc['speculative_candidates'])
+        self.txpool = TransactionPool(shc['txpool_max_size'], shc['txpool_max_per_sender'])
+        self.pending_senders = set()  # w/ pooled txs, see update_pending_nonces
+        self.builder = BlockBuilder(shc['block_gas_target'], shc['block_max_size'],
+                                    shc['block_build_time'])
+        self.batching = BatchingPolicy(shc['batch_window'], shc['batch_min_txs'],
+                                       shc['batch_min_gas'], shc['min_block_interval'])
+        self.tx_broadcast_queue = []
+        self.recent_transactions = LRUCache(self.recent_transactions_size)
+        self.announced_proposals = LRUCache(self.announced_proposals_size)  # blockhash: p
+        self.requested_proposals = dict()  # blockhash: proto
+        self.partial_proposals = dict()  # blockhash: (compact proposal, txs w/ None if missing)
         self.on_new_head_cbs = []
         self.on_new_head_candidate_cbs = []
+        self.alarms = AlarmScheduler()
+        self.transaction_alarms = EventAlarms()
+        self.consensus_requested = gevent.event.Event()
+        self.consensus_callbacks = []  # (cb, args) called after the next pass
+        self.consensus_worker = None
         self.newblock_processing_times = deque(maxlen=1000)
 
         # Consensus
@@ -208,8 +377,50 @@ class ChainService(eth_ChainService):
     def start(self):
         super(ChainService, self).start()
         self.consensus_manager.process()
+        self.consensus_worker = gevent.spawn(self.run_consensus)
         gevent.spawn(self.announce)
 
+    def stop(self):
+        if self.consensus_worker:
+            self.consensus_worker.kill()
+        self.flush()
+        self.alarms.stop()
+        self.verifier.stop()
+        super(ChainService, self).stop()
+
+    def run_consensus(self):
+        "processes the consensus once per burst of received messages"
+        while True:
+            self.consensus_requested.wait()
+            try:
+                self._process_consensus()
+            except Exception:
+                log.error('consensus processing failed', error=traceback.format_exc())
+
+    def process_consensus(self, cb=None, *args):
+        """
+        Requests a consensus pass. Messages are added to the consensus manager as they
+        are received, requests made until the pass starts are served by it.
+        cb is called w/ args after the pass.
+        W/o a running worker (e.g. simulations) the pass is scheduled as an alarm.
+        """
+        if cb is not None:
+            self.consensus_callbacks.append((cb, args))
+        if self.consensus_worker:
+            self.consensus_requested.set()
+        elif not self.consensus_requested.is_set():
+            self.consensus_requested.set()
+            self.setup_alarm(0, self._process_consensus)
+
+    def _process_consensus(self):
+        self.consensus_requested.clear()
+        callbacks, self.consensus_callbacks = self.consensus_callbacks, []
+        try:
+            self.consensus_manager.process()
+        finally:
+            for cb, args in callbacks:
+                cb(*args)
+
     def announce(self):
         while not self.consensus_manager.is_ready:
             self.consensus_manager.send_ready()
@@ -233,26 +444,41 @@ class ChainService(eth_ChainService):
         return time.time()
 
     def setup_alarm(self, delay, cb, *args):
-        log.debug('setting up alarm')
+        "returns a cancellable Alarm"
+        log.debug('setting up alarm', delay=delay, num_alarms=len(self.alarms))
+        return self.alarms.schedule(delay, cb, *args)
 
-        def _trigger():
-            gevent.sleep(delay)
-            log.debug('alarm triggered')
-            cb(*args)
-
-        gevent.spawn(_trigger)
+    @property
+    def num_alarms(self):
+        "number of pending, not cancelled alarms"
+        return len(self.alarms)
 
     def setup_transaction_alarm(self, cb, *args):
-        log.debug('setting up alarm')
-
-        class Trigger(object):
+        """
+        calls cb on the next new head_candidate, i.e. new transactions.
+        returns a cancellable Alarm, the pending one if set up for the same cb and args.
+        proposals are held back by the batching policy (see batch_delay), not by this alarm
+        """
+        log.debug('setting up transaction alarm')
+        return self.transaction_alarms.register(cb, *args)
 
-            def __call__(me, blk):
-                self.on_new_head_candidate_cbs.remove(me)
-                log.debug('transaction alarm triggered')
-                cb(*args)
+    def _on_new_head_candidate(self):
+        self.update_pending_nonces()
+        super(ChainService, self)._on_new_head_candidate()
+        self.transaction_alarms.trigger()
 
-        self.on_new_head_candidate_cbs.append(Trigger())
+    def update_pending_nonces(self):
+        """
+        Pooled txs are not applied to the head_candidate, but its nonces are queried as
+        the pending ones (e.g. by jsonrpc), so they are set to follow the pooled txs.
+        """
+        candidate, head = self.chain.head_candidate, self.chain.head
+        senders = set(self.txpool.queues)
+        for sender in self.pending_senders - senders:  # evicted or removed
+            candidate.set_nonce(sender, head.get_nonce(sender))
+        for sender in senders:
+            candidate.set_nonce(sender, self.txpool.queues[sender][-1].nonce + 1)
+        self.pending_senders = senders
 
     def commit_block(self, blk):
         assert isinstance(blk.header, HDCBlockHeader)
@@ -264,11 +490,31 @@ class ChainService(eth_ChainService):
         log.info('new head', head=self.chain.head)
         return success
 
+    def schedule_flush(self):
+        """
+        called when a block was added to the chain. the db is flushed after the next
+        consensus step, so proposing and voting on the next height don't wait on it.
+        the db only holds complete blocks (incl. their proposals and locksets),
+        so after a crash the consensus is recovered at the last flushed block.
+        """
+        self.unflushed_blocks += 1
+        if self.unflushed_blocks > self.config['hdc']['max_unflushed_blocks']:
+            self.flush()
+        elif self.unflushed_blocks == 1:
+            self.setup_alarm(0, self.flush)
+
+    def flush(self):
+        if self.unflushed_blocks:
+            log.debug('flushing db', num_blocks=self.unflushed_blocks)
+            self.unflushed_blocks = 0
+            self.db.commit()
+
     def link_block(self, t_block):
         assert isinstance(t_block.header, HDCBlockHeader)
         self.add_transaction_lock.acquire()
         block = self._link_block(t_block)
         if not block:
+            self.add_transaction_lock.release()
             return
         assert block.get_parent() == self.chain.head, (block.get_parent(), self.chain.head)
         assert block.header.coinbase == t_block.header.coinbase
@@ -288,6 +534,13 @@ class ChainService(eth_ChainService):
             return True  # already deserialized
         try:  # deserialize
             st = time.time()
+            for candidate in self.speculative.lookup(t_block):
+                if not isinstance(self.db, RefcountDB) and \
+                        self.verify_by_candidate(t_block, candidate):
+                    # the state is known, txs are only added to the tx trie
+                    self.import_candidate_state(candidate)
+                    self.db.put_temporarily('validated:' + t_block.hash, '1')
+                    break
             block = t_block.to_block(env=self.chain.env)
             elapsed = time.time() - st
             log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
@@ -301,29 +554,160 @@ class ChainService(eth_ChainService):
             return
         return block
 
+    def verify_by_candidate(self, t_block, candidate):
+        """
+        Verifies the state transition of t_block w/o replaying its txs, if they are a prefix
+        of the txs applied to candidate, a block on the same parent.
+        The intermediate states of candidate are only valid for t_block, if both have the
+        same execution context or if the txs don't depend on the differences:
+        plain value transfers, which don't run code incl. native contracts and specials,
+        and w/o fees if the coinbases differ.
+        """
+        header, txs = t_block.header, t_block.transaction_list
+        if not txs or t_block.uncles or len(txs) > candidate.transaction_count:
+            return False
+        if (header.prevhash, header.gas_limit) != (candidate.prevhash, candidate.gas_limit):
+            return False
+        if [tx.hash for tx in txs] != candidate.get_transaction_hashes()[:len(txs)]:
+            return False
+        parent = candidate.get_parent()
+        if (header.coinbase, header.timestamp, header.difficulty) != \
+                (candidate.coinbase, candidate.timestamp, candidate.difficulty):
+            if any(not tx.to or parent.get_code(tx.to) or tx.to in specials.specials
+                   for tx in txs):
+                return False  # code could read the context
+        if header.coinbase != candidate.coinbase:
+            # both coinbases are touched w/ 0, which is only a noop on existing accounts
+            if not (parent.account_exists(header.coinbase) and
+                    parent.account_exists(candidate.coinbase)):
+                return False
+            if any(tx.gasprice for tx in txs):
+                return False
+        receipts = Trie(candidate.db, BLANK_ROOT)
+        bloom = 0
+        for i in range(len(txs)):
+            receipt = candidate.get_receipt(i)
+            receipts.update(rlp.encode(i), rlp.encode(receipt))
+            bloom |= receipt.bloom
+        if (header.gas_used, header.bloom, header.receipts_root) != \
+                (receipt.gas_used, bloom, receipts.root_hash):
+            return False
+        # finalize the intermediate state in the context of t_block
+        block = Block.init_from_parent(parent, header.coinbase, timestamp=header.timestamp)
+        block.state_root = receipt.state_root
+        block.finalize()
+        verified = block.state_root == header.state_root
+        log.debug('verified by candidate', verified=verified, num_txs=len(txs))
+        return verified
+
+    def import_candidate_state(self, candidate):
+        "copies the trie nodes from the overlay db of the candidate"
+        for key, value in candidate.db.overlay.items():
+            if value is not None and len(key) == 32:
+                self.db.put(key, value)
+
     def add_transaction(self, tx, origin=None, force_broadcast=False):
+        "adds the tx to the pool, see add_transactions"
+        if self.is_syncing and force_broadcast:
+            assert origin is None  # only allowed for local txs
+            self.broadcast_transactions([tx])
+        return bool(self.add_transactions([tx], origin))
+
+    def add_transactions(self, transactions, origin=None):
         """
-        Warning:
-        Locking proposal_lock may block incoming events which are necessary to unlock!
-        I.e. votes / blocks!
-        Take care!
+        Adds a batch of transactions to the pool, they are applied when proposing.
+        Returns the list of added transactions.
         """
-        self.consensus_manager.log(
-            'add_transaction', blk=self.chain.head_candidate, lock=self.proposal_lock)
-        log.debug('add_transaction', lock=self.proposal_lock)
-        block = self.proposal_lock.block
-        self.proposal_lock.acquire()
-        self.consensus_manager.log('add_transaction acquired lock', lock=self.proposal_lock)
-        assert not hasattr(self.chain.head_candidate, 'should_be_locked')
-        success = super(ChainService, self).add_transaction(tx, origin, force_broadcast)
-        if self.proposal_lock.is_locked():  # can be unlock if we are at a new block
-            self.proposal_lock.release(if_block=block)
-        log.debug('added transaction', num_txs=self.chain.head_candidate.num_transactions())
-        return success
+        log.debug('add_transactions', num=len(transactions))
+        if self.is_syncing:
+            return []  # we can not evaluate the txs based on outdated state
+        transactions = self.prevalidate_transactions(transactions)
+        if not transactions:
+            return []
+        self.broadcast_transactions(transactions, origin=origin)  # asap
+        if origin is not None and not self.is_mining:
+            log.debug('discarding txs', mining=self.is_mining)
+            return []
+        head = self.chain.head
+        added = [tx for tx in transactions if self.txpool.add(tx, head.get_nonce(tx.sender))]
+        if added:
+            self.batching.on_transactions(self.now, len(added))
+            self._on_new_head_candidate()
+            if len(self.speculative.candidates):
+                self.setup_alarm(0, self.speculative.extend, head.hash, added)
+        log.debug('added transactions', num=len(added), pool=self.txpool)
+        return added
+
+    def prevalidate_transactions(self, transactions):
+        """
+        Filters unknown transactions which are valid if applied in order on the head,
+        after the txs of their senders in the pool.
+        Nonces and spent values are tracked per sender, so consecutive txs of a sender pass.
+        A tx w/ the nonce of a pooled one passes, the pool decides on the replacement.
+        """
+        block = self.chain.head
+        gas_limit = self.chain.head_candidate.gas_limit  # of the next block
+        nonces, spent = dict(), dict()
+        valid, seen = [], set()
+        for tx in transactions:
+            if tx.hash in seen or tx.hash in self.broadcast_filter or tx.hash in self.txpool:
+                continue
+            seen.add(tx.hash)
+            try:
+                if not tx.sender:
+                    raise InvalidTransaction('unsigned')
+                sender = tx.sender
+                if sender not in nonces:
+                    nonce = block.get_nonce(sender)
+                    queued = self.txpool.queued(sender, nonce)
+                    nonces[sender] = (nonce, nonce + len(queued))
+                    spent[sender] = sum(t.value for t in queued)
+                first, next_nonce = nonces[sender]
+                if not first <= tx.nonce <= next_nonce:
+                    raise InvalidTransaction('invalid nonce')
+                if tx.startgas < processblock.intrinsic_gas_used(tx):
+                    raise InvalidTransaction('insufficient startgas')
+                if tx.startgas > gas_limit:
+                    raise InvalidTransaction('startgas exceeds the block gas limit')
+                cost = tx.value + tx.gasprice * tx.startgas
+                if block.get_balance(sender) - spent[sender] < cost:
+                    raise InvalidTransaction('insufficient balance')
+            except InvalidTransaction as e:
+                log.debug('invalid tx', error=e)
+                continue
+            if tx.nonce == next_nonce:
+                nonces[sender] = (first, next_nonce + 1)
+                spent[sender] += tx.value  # gas is partially refunded, checked on application
+            valid.append(tx)
+        return valid
+
+    def batch_delay(self):
+        "secs until the pooled txs are to be proposed, None if there are none"
+        return self.batching.delay(self.now, len(self.txpool), self.txpool.startgas)
+
+    def build_block(self):
+        "a new block on the head w/ the best pooled txs, within the budget of the builder"
+        head = self.chain.head
+        block, invalid = self.builder.build(head, self.chain.coinbase, self.txpool.ordered())
+        for tx in invalid:
+            self.txpool.remove_stale(tx.sender, head.get_nonce(tx.sender))
+            self.txpool.remove(tx)
+        return block
 
     def _on_new_head(self, blk):
+        self.txpool.prune(blk.get_transactions())
+        self.batching.on_block(self.now, len(self.txpool))
         self.release_proposal_lock(blk)
         super(ChainService, self)._on_new_head(blk)
+        if self.config['hdc']['speculative_candidates']:
+            self.setup_alarm(0, self.speculate, blk)
+
+    def speculate(self, parent):
+        "builds the next block of the expected proposer, see SpeculativeExecutor"
+        proposer = self.consensus_contract.proposer(parent.number + 1, 0)
+        if parent != self.chain.head or proposer == self.chain.coinbase:
+            return  # outdated, or our own block built from the pool when proposing
+        self.speculative.execute(parent, proposer, list(self.txpool.ordered()))
 
     def set_proposal_lock(self, blk):
         log.debug('set_proposal_lock', locked=self.proposal_lock)
@@ -366,27 +750,24 @@ class ChainService(eth_ChainService):
         log.debug('remote_transactions_received', count=len(transactions), remote_id=proto)
 
         def _add_txs():
-            for tx in transactions:
-                self.add_transaction(tx, origin=proto)
-        gevent.spawn(_add_txs)  # so the locks in add_transaction won't lock the connection
+            self.verifier.recover_tx_senders(transactions)
+            self.add_transactions(transactions, origin=proto)
+        gevent.spawn(_add_txs)  # so the locks in add_transactions won't lock the connection
 
     # blocks / proposals ################
 
     def on_receive_getblockproposals(self, proto, blocknumbers):
         log.debug('----------------------------------')
         log.debug("on_receive_getblockproposals", count=len(blocknumbers))
-        found = []
+        blocknumbers = blocknumbers[:self.wire_protocol.max_blockproposals_count]
         for i, height in enumerate(blocknumbers):
-            if i == self.wire_protocol.max_getproposals_count:
-                break
             assert isinstance(height, int)  # integers
             assert i == 0 or height > blocknumbers[i - 1]   # sorted
-            if height > self.chain.head.number:
-                log.debug("unknown block requested", height=height)
-                break
-            rlp_data = self.consensus_manager.get_blockproposal_rlp_by_height(height)
-            assert isinstance(rlp_data, bytes)
-            found.append(rlp_data)
+        heights = [h for h in blocknumbers if h <= self.chain.head.number]
+        if len(heights) < len(blocknumbers):
+            log.debug("unknown blocks requested", num=len(blocknumbers) - len(heights))
+        found = self.consensus_manager.get_blockproposals_rlp(
+            heights, max_bytes=self.wire_protocol.max_blockproposals_bytes)
         if found:
             log.debug("found", count=len(found))
             proto.send_blockproposals(*found)
@@ -395,9 +776,12 @@ class ChainService(eth_ChainService):
         log.debug('----------------------------------')
         self.consensus_manager.log('received proposals', sender=proto)
         log.debug("recv proposals", num=len(proposals), remote_id=proto)
-        self.consensus_manager.synchronizer.receive_blockproposals(proposals)
+        self.consensus_manager.synchronizer.receive_blockproposals(proposals, proto,
+                                                                   proto.packet_size)
 
     def on_receive_newblockproposal(self, proto, proposal):
+        self.requested_proposals.pop(proposal.blockhash, None)
+        self.partial_proposals.pop(proposal.blockhash, None)
         if proposal.hash in self.broadcast_filter:
             return
         log.debug('----------------------------------')
@@ -409,7 +793,84 @@ class ChainService(eth_ChainService):
         isvalid = self.consensus_manager.add_proposal(proposal, proto)
         if isvalid:
             self.broadcast(proposal, origin=proto)
-        self.consensus_manager.process()
+        self.process_consensus()
+
+    def on_receive_newcompactblockproposal(self, proto, proposal):
+        blockhash = proposal.blockhash
+        if blockhash in self.requested_proposals or blockhash in self.announced_proposals \
+                or blockhash in self.consensus_manager.block_candidates:
+            return
+        log.debug('----------------------------------')
+        log.debug("recv newcompactblockproposal", proposal=proposal, remote_id=proto)
+        transactions = self.lookup_transactions(proposal)
+        missing = [i for i, tx in enumerate(transactions) if tx is None]
+        if missing:
+            log.debug('requesting txs', num=len(missing), remote_id=proto)
+            self.partial_proposals[blockhash] = (proposal, transactions)
+            self.request_proposal(proto, blockhash, 'getblocktransactions', missing)
+        else:
+            self.rebuild_proposal(proto, proposal, transactions)
+
+    def on_receive_blocktransactions(self, proto, blockhash, transactions):
+        if self.requested_proposals.get(blockhash) is not proto \
+                or blockhash not in self.partial_proposals:
+            return
+        log.debug("recv blocktransactions", num=len(transactions), remote_id=proto)
+        proposal, txs = self.partial_proposals.pop(blockhash)
+        missing = [i for i, tx in enumerate(txs) if tx is None]
+        if len(missing) != len(transactions):
+            return self.request_proposal(proto, blockhash, 'getblockproposal')
+        for i, tx in zip(missing, transactions):
+            txs[i] = tx
+        self.rebuild_proposal(proto, proposal, txs)
+
+    def rebuild_proposal(self, proto, proposal, transactions):
+        try:
+            p = proposal.to_proposal(transactions)
+        except (InvalidProposalError, InvalidSignature) as e:  # e.g. a short id collision
+            log.debug('could not rebuild proposal', error=e)
+            return self.request_proposal(proto, proposal.blockhash, 'getblockproposal')
+        self.on_receive_newblockproposal(proto, p)
+
+    def request_proposal(self, proto, blockhash, cmd, *args):
+        "requests (the missing txs of) an announced proposal"
+        self.requested_proposals[blockhash] = proto
+        getattr(proto, 'send_' + cmd)(blockhash, *args)
+        self.setup_alarm(self.config['hdc']['proposal_request_timeout'],
+                         self.on_proposal_request_timeout, blockhash, proto)
+
+    def on_proposal_request_timeout(self, blockhash, proto):
+        "allows to request it from the next peer announcing it"
+        if self.requested_proposals.get(blockhash) is proto:
+            del self.requested_proposals[blockhash]
+            self.partial_proposals.pop(blockhash, None)
+
+    def get_announced_proposal(self, blockhash):
+        p = self.announced_proposals.get(blockhash)
+        return p or self.consensus_manager.get_blockproposal(blockhash)
+
+    def on_receive_getblockproposal(self, proto, blockhash):
+        p = self.get_announced_proposal(blockhash)
+        if p is not None:
+            proto.send_newblockproposal(p)
+
+    def on_receive_getblocktransactions(self, proto, blockhash, indexes):
+        p = self.get_announced_proposal(blockhash)
+        if p is not None:
+            txs = p.block.transaction_list
+            proto.send_blocktransactions(blockhash, [txs[i] for i in indexes if i < len(txs)])
+
+    def lookup_transactions(self, proposal):
+        "the known txs of a compact proposal, None for unknown or ambiguous ones"
+        known = self.recent_transactions.d.values() + self.txpool.transactions.values()
+        tx_ids = CompactBlockProposal.short_ids(proposal.blockhash, [tx.hash for tx in known])
+        by_id = dict()
+        for tx_id, tx in zip(tx_ids, known):
+            if tx_id in by_id and (by_id[tx_id] is None or by_id[tx_id].hash != tx.hash):
+                by_id[tx_id] = None  # collision
+            else:
+                by_id[tx_id] = tx
+        return [by_id.get(tx_id) for tx_id in proposal.transaction_ids]
 
     def on_receive_votinginstruction(self, proto, votinginstruction):
         if votinginstruction.hash in self.broadcast_filter:
@@ -421,7 +882,7 @@ class ChainService(eth_ChainService):
         if isvalid:
             self.broadcast(votinginstruction, origin=proto)
 
-        self.consensus_manager.process()
+        self.process_consensus()
 
     #  votes
 
@@ -435,7 +896,7 @@ class ChainService(eth_ChainService):
         isvalid = self.consensus_manager.add_vote(vote, proto)
         if isvalid:
             self.broadcast(vote, origin=proto)
-        self.consensus_manager.process()
+        self.process_consensus()
 
     def on_receive_ready(self, proto, ready):
         if ready.hash in self.broadcast_filter:
@@ -444,7 +905,7 @@ class ChainService(eth_ChainService):
         log.debug("recv ready", ready=ready, remote_id=proto)
         self.consensus_manager.add_ready(ready, proto)
         self.broadcast(ready, origin=proto)
-        self.consensus_manager.process()
+        self.process_consensus()
 
     #  start
 
@@ -465,23 +926,25 @@ class ChainService(eth_ChainService):
         assert isinstance(current_lockset, LockSet)
         if len(current_lockset):
             log.debug('adding received lockset', ls=current_lockset)
+            self.verifier.recover_senders(current_lockset.votes)
             for v in current_lockset.votes:
                 self.consensus_manager.add_vote(v, proto)
 
-        self.consensus_manager.process()
-
-        # send last BlockProposal
-        p = self.consensus_manager.last_blockproposal
-        if p:
-            log.debug('sending proposal', p=p)
-            proto.send_newblockproposal(p)
+        # the last proposal must be voted on, before it is sent
+        self.process_consensus(self.send_last_blockproposal, proto)
 
         # send transactions
-        transactions = self.chain.get_transactions()
+        transactions = list(self.txpool.ordered())
         if transactions:
             log.debug("sending transactions", remote_id=proto)
             proto.send_transactions(*transactions)
 
+    def send_last_blockproposal(self, proto):
+        p = self.consensus_manager.last_blockproposal
+        if p and not proto.is_stopped:
+            log.debug('sending proposal', p=p)
+            proto.send_newblockproposal(p)
+
     def on_wire_protocol_start(self, proto):
         log.debug('----------------------------------')
         log.debug('on_wire_protocol_start', proto=proto)
@@ -492,6 +955,11 @@ class ChainService(eth_ChainService):
         proto.receive_blockproposals_callbacks.append(self.on_receive_blockproposals)
         proto.receive_getblockproposals_callbacks.append(self.on_receive_getblockproposals)
         proto.receive_newblockproposal_callbacks.append(self.on_receive_newblockproposal)
+        proto.receive_newcompactblockproposal_callbacks.append(
+            self.on_receive_newcompactblockproposal)
+        proto.receive_getblockproposal_callbacks.append(self.on_receive_getblockproposal)
+        proto.receive_getblocktransactions_callbacks.append(self.on_receive_getblocktransactions)
+        proto.receive_blocktransactions_callbacks.append(self.on_receive_blocktransactions)
         proto.receive_votinginstruction_callbacks.append(self.on_receive_votinginstruction)
         proto.receive_vote_callbacks.append(self.on_receive_vote)
         proto.receive_ready_callbacks.append(self.on_receive_ready)
@@ -509,16 +977,48 @@ class ChainService(eth_ChainService):
         """
         """
         fmap = {BlockProposal: 'newblockproposal', VoteBlock: 'vote', VoteNil: 'vote',
-                VotingInstruction: 'votinginstruction', Transaction: 'transactions',
-                Ready: 'ready'}
+                VotingInstruction: 'votinginstruction', Ready: 'ready'}
+        if isinstance(obj, Transaction):
+            return self.broadcast_transactions([obj], origin=origin)
         if self.broadcast_filter.update(obj.hash) == False:
             log.debug('already broadcasted', obj=obj)
             return
+        cmd = fmap[type(obj)]
         if isinstance(obj, BlockProposal):
             assert obj.sender == obj.block.header.coinbase
+            min_size = self.config['hdc']['compact_proposal_min_size']
+            if min_size and len(rlp.encode(obj)) >= min_size:
+                self.announced_proposals[obj.blockhash] = obj  # served on request
+                self.flush_tx_broadcast_queue()  # so peers can rebuild it
+                cmd, obj = 'newcompactblockproposal', CompactBlockProposal.from_proposal(obj)
         log.debug('broadcasting', obj=obj)
         bcast = self.app.services.peermanager.broadcast
-        bcast(HDCProtocol, fmap[type(obj)], args=(obj,),
+        bcast(HDCProtocol, cmd, args=(obj,),
               exclude_peers=[origin.peer] if origin else [])
 
-    broadcast_transaction = broadcast
+    def broadcast_transaction(self, tx, origin=None):
+        self.broadcast_transactions([tx], origin=origin)
+
+    def broadcast_transactions(self, transactions, origin=None):
+        """
+        queues the not yet broadcasted txs, which are sent in batches after tx_broadcast_delay.
+        peers only get the txs they don't know (incl. the origin which sent them).
+        """
+        transactions = [tx for tx in transactions if self.broadcast_filter.update(tx.hash)]
+        if not transactions:
+            return
+        for tx in transactions:
+            self.recent_transactions[tx.hash] = tx
+        self.tx_broadcast_queue.extend(transactions)
+        delay = self.config['hdc']['tx_broadcast_delay']
+        if not delay:
+            self.flush_tx_broadcast_queue()
+        elif len(self.tx_broadcast_queue) == len(transactions):  # window opened
+            self.setup_alarm(delay, self.flush_tx_broadcast_queue)
+
+    def flush_tx_broadcast_queue(self):
+        transactions, self.tx_broadcast_queue = self.tx_broadcast_queue, []
+        if transactions:
+            log.debug('broadcasting txs', num=len(transactions))
+            bcast = self.app.services.peermanager.broadcast
+            bcast(HDCProtocol, 'new_transactions', args=tuple(transactions))
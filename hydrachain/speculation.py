@@ -0,0 +1,82 @@
+import time
+import gevent
+import gevent.lock
+from ethereum import processblock
+from ethereum.blocks import Block
+from ethereum.config import Env
+from ethereum.db import OverlayDB
+from ethereum.exceptions import InvalidTransaction
+from ethereum.slogging import get_logger
+from .utils import LRUCache, sha3
+
+log = get_logger('hdc.speculation')
+
+
+class SpeculativeExecutor(object):
+
+    """
+    Applies the pending transactions on top of the expected parent of the next proposal,
+    in the context of its expected proposer. The txs of the proposal are then verified
+    by the intermediate states (see ChainService.verify_by_candidate) instead of replayed.
+
+    Candidates are cached by parent hash and the hash of their tx list. Each holds the
+    trie nodes it created in an OverlayDB, so their number is bounded by max_candidates.
+    """
+
+    def __init__(self, max_candidates=2):
+        self.candidates = LRUCache(max_candidates)
+        self.lock = gevent.lock.Semaphore()
+
+    def __repr__(self):
+        return '<SpeculativeExecutor(candidates=%d)>' % len(self.candidates)
+
+    @staticmethod
+    def key(parent_hash, tx_hashes):
+        return parent_hash, sha3(''.join(tx_hashes))
+
+    def lookup(self, t_block):
+        "candidates for the block, the one w/ the same txs first"
+        tx_hashes = [tx.hash for tx in t_block.transaction_list]
+        c = self.candidates.get(self.key(t_block.prevhash, tx_hashes))
+        found = [] if c is None else [c]
+        return found + [c for (h, _), c in self.candidates.d.items()
+                        if h == t_block.prevhash and c not in found]
+
+    def execute(self, parent, coinbase, transactions, timestamp=None):
+        "creates a candidate on parent, the timestamp defaults to the one Chain would use"
+        timestamp = timestamp or max(int(time.time()), parent.timestamp + 1)
+        env = Env(OverlayDB(parent.db), parent.config, parent.env.global_config)
+        candidate = Block.init_from_parent(parent, coinbase, timestamp=timestamp, env=env)
+        self.candidates[self.key(parent.hash, [])] = candidate
+        self.apply(candidate, transactions)
+        return candidate
+
+    def extend(self, parent_hash, transactions):
+        "applies the txs to the candidates on parent"
+        for (h, _), candidate in self.candidates.d.items():
+            if h == parent_hash:
+                self.apply(candidate, transactions)
+
+    def apply(self, candidate, transactions):
+        "applies the unknown txs, invalid ones are skipped"
+        self.lock.acquire()
+        try:
+            tx_hashes = candidate.get_transaction_hashes()
+            key = self.key(candidate.prevhash, tx_hashes)
+            known = set(tx_hashes)
+            for tx in transactions:
+                if tx.hash in known:
+                    continue
+                try:
+                    processblock.apply_transaction(candidate, tx)
+                except InvalidTransaction as e:
+                    log.debug('invalid tx', error=e)
+                    continue
+                known.add(tx.hash)
+                tx_hashes.append(tx.hash)
+                gevent.sleep(0)  # don't delay the processing of votes and proposals
+            self.candidates.d.pop(key, None)
+            self.candidates[self.key(candidate.prevhash, tx_hashes)] = candidate
+        finally:
+            self.lock.release()
+        log.debug('applied', candidate=candidate, num_txs=len(tx_hashes))
@@ -0,0 +1,56 @@
+from hydrachain.alarms import AlarmScheduler
+import gevent
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_scheduler_order_and_cancel():
+    clock = Clock()
+    scheduler = AlarmScheduler(clock)
+    fired = []
+    for delay in (3, 1, 2, 1):
+        scheduler.schedule(delay, fired.append, delay)
+    a = scheduler.schedule(2, fired.append, 'cancelled')
+    assert len(scheduler) == 5
+    a.cancel()
+    a.cancel()
+    assert len(scheduler) == 4
+    clock.now = 2
+    due = scheduler.pop_due()
+    assert [alarm.args for alarm in due] == [(1,), (1,), (2,)]
+    assert len(scheduler) == 1
+    due[0].cancel()  # already taken from the heap
+    assert len(scheduler) == 1
+    for alarm in due:
+        alarm.fire()
+    assert fired == [1, 2]
+    scheduler.stop()
+
+
+def test_scheduler_compacts():
+    scheduler = AlarmScheduler(Clock())
+    alarms = [scheduler.schedule(i, lambda: None) for i in range(100)]
+    for alarm in alarms[:90]:
+        alarm.cancel()
+    assert len(scheduler) == 10
+    assert len(scheduler.heap) < 100
+    scheduler.stop()
+
+
+def test_scheduler_runs():
+    scheduler = AlarmScheduler()
+    fired = []
+    scheduler.schedule(0.05, fired.append, 'late')
+    scheduler.schedule(0.01, fired.append, 'early')  # wakes up the waiting scheduler
+    scheduler.schedule(0.02, fired.append, 'cancelled').cancel()
+    gevent.sleep(0.1)
+    assert fired == ['early', 'late']
+    assert len(scheduler) == 0
+    scheduler.stop()
@@ -3,6 +3,7 @@ from hydrachain.consensus.base import Vote, VoteBlock, VoteNil, LockSet, ishash,
 from hydrachain.consensus.base import DoubleVotingError, InvalidVoteError, MissingSignatureError
 from hydrachain.consensus.base import BlockProposal, genesis_signing_lockset, InvalidProposalError
 from hydrachain.consensus.base import Proposal, VotingInstruction, InvalidSignature, Signed
+from hydrachain.consensus.base import recover_senders, signed_objects, signature_cache
 
 
 from ethereum import utils, tester
@@ -25,6 +26,44 @@ def test_signed():
     assert s.hash == h
 
 
+def test_cached_hashes():
+    v = VoteBlock(2, 0, '0' * 32)
+    v.sign(privkey)
+    h = v.hash
+    assert v._cached_hash is None  # not frozen
+
+    vd = rlp.decode(rlp.encode(v), Vote)
+    assert not vd.is_mutable()
+    assert vd.hash == h
+    assert vd._cached_hash == h
+    assert vd._cached_rawhash == vd.rawhash == v.rawhash
+    assert vd == v
+
+    # mutating resets the caches
+    vd._mutable = True
+    vd.round = 1
+    assert vd._cached_hash is None
+    assert vd._cached_rlp is None
+    assert vd._cached_rawhash is None
+    assert vd.hash != h
+    assert vd.rawhash != v.rawhash
+
+    # sedes are built with the class
+    assert VoteBlock._hash_sedes is VoteBlock._hash_sedes
+    assert [f for f, _ in Vote._unsigned_sedes.fields] == ['height', 'round', 'blockhash']
+
+    # locksets reset their caches when votes are added
+    ls = LockSet(len(privkeys), [v])
+    lsd = rlp.decode(rlp.encode(ls), LockSet)
+    h = lsd.hash
+    assert lsd._cached_hash == h
+    v2 = VoteBlock(2, 0, '0' * 32)
+    v2.sign(privkeys[0])
+    lsd.add(v2)
+    assert lsd._cached_hash is None
+    assert lsd.hash != h
+
+
 def test_vote():
     h, r = 2, 3
     bh = '0' * 32
@@ -91,6 +130,65 @@ def test_ready():
     assert s != s1
 
 
+def test_recover_senders():
+    signature_cache.clear()
+    bh = '0' * 32
+    votes = []
+    for privkey in privkeys[:3]:
+        v = VoteBlock(1, 0, bh)
+        v.sign(privkey)
+        votes.append(v)
+    # decoded copies carry the same signatures
+    copies = [rlp.decode(rlp.encode(v), Vote) for v in votes]
+    unsigned = VoteNil(1, 0)
+    invalid = VoteNil(1, 0, v=27, r=0, s=1)
+    assert recover_senders(votes + copies + [unsigned, invalid]) == 3
+    for v, c, addr in zip(votes, copies, validators):
+        assert v._sender == c._sender == addr
+    assert unsigned.sender is None
+    assert invalid._sender is None
+    with pytest.raises(InvalidSignature):
+        invalid.sender
+    # nothing left to recover
+    assert recover_senders(votes + copies) == 0
+
+    ls = LockSet(len(validators), votes)
+    r = Ready(0, ls)
+    r.sign(privkey)
+    assert signed_objects(r) == [r] + votes
+    assert signed_objects(ls, r) == votes + [r] + votes
+
+
+def test_signature_cache():
+    signature_cache.clear()
+    v = VoteBlock(5, 0, '0' * 32)
+    v.sign(privkeys[0])
+    hits, misses = signature_cache.hits, signature_cache.misses
+    assert v.sender == validators[0]
+    assert signature_cache.misses == misses + 1
+    assert len(signature_cache) == 1
+
+    # received again, e.g. within a lockset
+    vd = rlp.decode(rlp.encode(v), Vote)
+    assert vd.sender == validators[0]
+    assert signature_cache.hits == hits + 1
+    ls = LockSet(len(validators), [rlp.decode(rlp.encode(v), Vote)])
+    assert ls.votes[0].sender == validators[0]
+    assert signature_cache.hits == hits + 2
+    assert signature_cache.misses == misses + 1
+    assert signature_cache.hit_rate > 0
+
+    # bounded
+    max_items = signature_cache.max_items
+    signature_cache.max_items = 2
+    for i in range(3):
+        v = VoteNil(5, i)
+        v.sign(privkeys[0])
+        v.sender
+    assert len(signature_cache) == 2
+    signature_cache.max_items = max_items
+
+
 def test_LockSet():
     ls = LockSet(num_eligible_votes=len(privkeys))
     assert not ls
@@ -155,6 +253,41 @@ def test_LockSet():
     assert v3_2 not in ls
 
 
+def test_LockSet_index():
+    ls = LockSet(num_eligible_votes=len(privkeys))
+    h, r = 3, 2
+    votes = []
+    for i, privkey in enumerate(privkeys[:7]):
+        v = VoteBlock(h, r, ('0' if i < 5 else '1') * 32)
+        v.sign(privkey)
+        votes.append(v)
+        ls.add(v)
+    assert ls.get(validators[0]) == votes[0]
+    assert ls.get(validators[9]) is None
+    assert ls.blockhashes() == [('0' * 32, 5), ('1' * 32, 2)]
+    assert ls.has_quorum_possible == '0' * 32
+
+    # replacing a vote updates the index and the tally
+    v = VoteBlock(h, r, '1' * 32)
+    v.sign(privkeys[0])
+    assert v not in ls
+    with pytest.raises(DoubleVotingError):
+        ls.add(v)
+    assert ls.add(v, force_replace=True)
+    assert v in ls
+    assert votes[0] not in ls
+    assert ls.get(validators[0]) == v
+    assert len(ls) == 7
+    assert ls.blockhashes() == [('0' * 32, 4), ('1' * 32, 3)]
+    assert ls.has_quorum_possible == '0' * 32
+
+    # same wire format and index after decoding
+    d = rlp.decode(rlp.encode(ls), LockSet)
+    assert d.votes == ls.votes
+    assert d.get(validators[0]) == v
+    assert d.blockhashes() == ls.blockhashes()
+
+
 def test_one_vote_lockset():
     ls = LockSet(num_eligible_votes=1)
     bh = '0' * 32
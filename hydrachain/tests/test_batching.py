@@ -0,0 +1,41 @@
+from hydrachain.batching import BatchingPolicy
+
+
+def test_default_proposes_at_once():
+    policy = BatchingPolicy()
+    assert policy.delay(0, 0, 0) is None
+    policy.on_transactions(0, 1)
+    assert policy.delay(0, 1, 21000) == 0
+
+
+def test_window_and_thresholds():
+    policy = BatchingPolicy(window=1., min_txs=10, min_gas=21000 * 20)
+    policy.on_transactions(0, 1)
+    assert policy.delay(0, 1, 21000) == 1.  # rate unknown, wait for the window
+    assert policy.delay(1.5, 1, 21000) == 0
+    assert policy.delay(0, 10, 21000 * 10) == 0  # enough txs
+    assert policy.delay(0, 5, 21000 * 20) == 0  # enough gas
+    policy.on_block(2., 0)
+    assert policy.first_pending is None
+
+
+def test_adaptive_to_arrival_rate():
+    policy = BatchingPolicy(window=1., min_txs=100)
+    for i in range(10):
+        policy.on_transactions(i * 0.01, 1)  # 100 txs / sec
+    assert abs(policy.rate - 100) < 1
+    assert 0 < policy.delay(0.1, 10, 0) < 1.
+    # further txs are not expected, when they stopped arriving
+    policy = BatchingPolicy(window=1.)
+    policy.on_transactions(0, 1)
+    policy.on_transactions(0.5, 1)  # 2 txs / sec
+    assert policy.delay(0.5, 2, 0) == 0.5
+    assert policy.delay(0.9, 2, 0) == 0  # < 1 tx expected within the rest of the window
+
+
+def test_min_interval():
+    policy = BatchingPolicy(min_interval=2.)
+    policy.on_block(10., 0)
+    policy.on_transactions(11., 1)
+    assert policy.delay(11., 1, 0) == 1.
+    assert policy.delay(12., 1, 0) == 0
@@ -7,6 +7,7 @@ from devp2p.app import BaseApp
 from hydrachain.consensus.protocol import HDCProtocol
 from hydrachain.consensus.base import genesis_signing_lockset, VoteNil, VoteBlock, LockSet
 from hydrachain.consensus.base import VotingInstruction, BlockProposal, TransientBlock
+from hydrachain.consensus.base import aggregate_lockset, map_locksets
 
 
 tester.disable_logging()
@@ -93,10 +94,14 @@ def test_blocks():
     chain.mine(n=2)
     assert len(chain.blocks) == 3
     proposals = [create_proposal(b) for b in chain.blocks[1:]]
-    payload = [rlp.encode(p) for p in proposals]
+    full = [rlp.encode(p) for p in proposals]
+    # as served by the store, w/ aggregated locksets
+    payload = [rlp.codec.encode_raw(map_locksets(BlockProposal, rlp.decode(rlp.encode(p)),
+                                                 aggregate_lockset)) for p in proposals]
     proto.send_blockproposals(*payload)
     packet = peer.packets.pop()
     assert len(rlp.decode(packet.payload)) == 2
+    assert len(packet.payload) < sum(len(x) for x in full)
 
     def list_cb(proto, blocks):
         cb_data.append((proto, blocks))
@@ -115,6 +120,7 @@ def test_blocks():
         # assert that transactions and uncles have not been decoded
         assert len(proposal.block.transaction_list) == 0
         assert len(proposal.block.uncles) == 0
+    assert [rlp.encode(p) for p in proposals] == full
 
 
 def test_blockproposal():
@@ -169,6 +175,44 @@ def test_getblockproposals():
     assert data == tuple(payload)
 
 
+class VerifierMock(object):
+
+    workers = [None]
+
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, keys):
+        self.prefetched.extend(keys)
+
+
+def test_prefetch_signatures(monkeypatch):
+    peer, proto, chain, cb_data, cb = setup()
+    proto.service.verifier = VerifierMock()
+    decoded = []
+    get_sedes = HDCProtocol.vote.get_sedes
+    monkeypatch.setattr(HDCProtocol.vote, 'get_sedes',
+                        classmethod(lambda cls: decoded.append(1) or get_sedes()))
+
+    def list_cb(proto, vote):
+        cb_data.append((proto, vote))
+    proto.receive_vote_callbacks.append(list_cb)
+    v = VoteBlock(1, 0, '0' * 32)
+    v.sign(privkeys[0])
+    proto.send_vote(v)
+    del decoded[:]  # by encoding
+    proto.receive_packet(peer.packets.pop())
+    assert proto.service.verifier.prefetched == [v.signature_key()]
+    assert cb_data.pop()[1] == v
+    assert len(decoded) == 1  # decoded once, for the prefetch and the command
+
+    # w/o votes or locksets, nothing is prefetched
+    proto.receive_transactions_callbacks.append(lambda proto, txs: None)
+    proto.send_transactions()
+    proto.receive_packet(peer.packets.pop())
+    assert len(proto.service.verifier.prefetched) == 1
+
+
 def test_vote():
     peer, proto, chain, cb_data, cb = setup()
 
@@ -6,12 +6,17 @@ from pyethapp.accounts import Account, AccountsService
 from ethereum import slogging
 from ethereum import utils
 from ethereum import config as eth_config
+from ethereum import processblock
+from ethereum.transactions import Transaction
 from hydrachain import hdc_service
+from hydrachain.builder import BlockBuilder
 from hydrachain.consensus import protocol as hdc_protocol
+from hydrachain.consensus import manager
 from hydrachain.consensus.base import Block, BlockProposal, VoteBlock, VoteNil, TransientBlock
 from hydrachain.consensus.base import InvalidProposalError, LockSet, Ready
 import ethereum.keys
 import rlp
+import gevent
 import tempfile
 slogging.configure(config_string=':info')
 
@@ -22,6 +27,16 @@ privkeys = [chr(i) * 32 for i in range(1, 11)]
 validators = [utils.privtoaddr(p) for p in privkeys]
 
 
+def mk_txs(key, nonces, startgas=21000, gasprice=0, value=0, to='x' * 20):
+    "signed txs of privkeys[key] w/ the given nonces"
+    txs = []
+    for nonce in nonces:
+        tx = Transaction(nonce, gasprice, startgas=startgas, to=to, value=value, data='')
+        tx.sign(privkeys[key])
+        txs.append(tx)
+    return txs
+
+
 empty = object()
 
 
@@ -74,6 +89,435 @@ def test_receive_proposal():
     # assert chainservice.chain.head.number == 1  # we don't have consensus yet
 
 
+def test_proposal_store():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    cm = chainservice.consensus_manager
+    store = cm.store
+    p = cm.active_round.mk_proposal()
+    ls = cm.mk_lockset(p.height)
+    for privkey in privkeys:
+        v = VoteBlock(p.height, 0, p.blockhash)
+        v.sign(privkey)
+        ls.add(v)
+    store.stage(p, ls)
+    assert store.load_proposal_rlp(p.height) is None  # block not stored yet
+    chainservice.db.put(p.blockhash, rlp.encode(p.block))
+    assert store.load_proposal_rlp(p.height) == rlp.encode(p)
+    assert store.load_proposal_rlp_by_blockhash(p.blockhash) == rlp.encode(p)
+    assert store.load_proposal(p.height) == p
+    assert store.load_lockset(p.height) == ls
+    assert list(store.iter_proposals_rlp(1)) == [(1, rlp.encode(p))]
+    klass = hdc_protocol.HDCProtocol.blockproposals
+    aggregated = store.load_proposal_rlp(p.height, aggregated=True)
+    assert klass.decode_payload(klass.encode_payload((aggregated,))) == (p,)
+    assert cm.load_proposal(p.blockhash) == p
+    store.revert()
+    assert store.load_proposal(p.height) is None
+    assert store.load_proposal_rlp_by_blockhash(p.blockhash) is None
+    assert store.load_lockset(p.height) is None
+
+    # dbs of older versions
+    chainservice.db.put('blockproposal:%s' % p.blockhash, rlp.encode(p))
+    chainservice.db.put('last_committing_lockset', rlp.encode(ls))
+    assert store.load_proposal_rlp_by_blockhash(p.blockhash) == rlp.encode(p)
+    assert store.load_proposal_rlp_by_blockhash(p.blockhash, aggregated=True) == aggregated
+    assert store.load_lockset(p.height) == ls
+    assert store.load_lockset(p.height + 1) is None
+
+
+def test_stale_proposal_not_recovered(monkeypatch):
+    recovered = []
+    monkeypatch.setattr(manager, 'recover_senders', recovered.append)
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    cm = chainservice.consensus_manager
+    p = cm.active_round.mk_proposal()
+    assert chainservice.commit_block(p.block)
+    stale = rlp.decode(rlp.encode(p), BlockProposal)
+    assert stale.height < cm.height
+    cm.add_proposal(stale)
+    assert recovered == []  # the signatures of stale proposals are not recovered
+
+
+def test_add_transactions(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    broadcasted = []
+    monkeypatch.setattr(app.services.peermanager, 'broadcast', classmethod(
+        lambda cls, proto, cmd, args, **kargs: broadcasted.append((cmd, args))))
+    txs = mk_txs(1, (0, 1, 2, 5))  # 5 has an invalid nonce
+    added = chainservice.add_transactions(txs + txs[:1])
+    assert added == txs[:3]
+    assert len(chainservice.txpool) == 3
+    assert chainservice.chain.head_candidate.num_transactions() == 0  # applied when proposing
+    assert broadcasted == []  # queued
+    chainservice.flush_tx_broadcast_queue()
+    assert broadcasted == [('new_transactions', tuple(txs[:3]))]
+    assert chainservice.add_transactions(txs) == []
+    assert len(broadcasted) == 1
+    gas_limit = chainservice.chain.head_candidate.gas_limit
+    too_big = mk_txs(1, [3], startgas=gas_limit + 1)
+    assert chainservice.add_transactions(too_big) == []  # can never be included
+
+    # not blocked by a proposal, included in the next one
+    p = chainservice.consensus_manager.active_round.mk_proposal()
+    assert chainservice.proposal_lock.is_locked()
+    tx, = mk_txs(1, [3])
+    assert chainservice.add_transaction(tx)
+    assert p.block.transaction_list == txs[:3]
+    assert chainservice.commit_block(p.block)
+    assert list(chainservice.txpool.ordered()) == [tx]
+
+
+def test_pending_nonce():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    sender = utils.privtoaddr(privkeys[1])
+    for tx in mk_txs(1, range(2)):
+        assert chainservice.chain.head_candidate.get_nonce(sender) == tx.nonce
+        assert chainservice.add_transaction(tx)
+    assert chainservice.chain.head_candidate.get_nonce(sender) == 2
+    assert chainservice.chain.head.get_nonce(sender) == 0
+    chainservice.txpool.remove_stale(sender, 2)  # e.g. evicted
+    chainservice._on_new_head_candidate()
+    assert chainservice.chain.head_candidate.get_nonce(sender) == 0
+
+
+def test_block_builder_budget():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    head = chainservice.chain.head
+    txs = dict((key, mk_txs(key, range(3))) for key in (1, 2))
+    ordered = txs[1] + txs[2]
+    block, invalid = BlockBuilder().build(head, head.coinbase, ordered)
+    assert block.transaction_list == ordered and invalid == []
+    block, _ = BlockBuilder(gas_target=21000 * 4).build(head, head.coinbase, ordered)
+    assert block.transaction_list == ordered[:4]
+    size = len(rlp.encode(ordered[0]))
+    block, _ = BlockBuilder(max_size=size * 2).build(head, head.coinbase, ordered)
+    assert block.transaction_list == ordered[:2]
+    # a sender is skipped from its first tx which does not fit
+    big, = mk_txs(1, [3], startgas=10 ** 6)
+    block, _ = BlockBuilder(gas_target=21000 * 6).build(head, head.coinbase,
+                                                        txs[1] + [big] + txs[2])
+    assert block.transaction_list == ordered
+    # a tx which can never fit is invalid, the pool drops it
+    huge, = mk_txs(1, [3], startgas=head.gas_limit * 2)
+    block, invalid = BlockBuilder().build(head, head.coinbase, txs[1] + [huge])
+    assert block.transaction_list == txs[1] and invalid == [huge]
+    for tx in txs[1] + [huge]:  # e.g. the gas limit decreased
+        chainservice.txpool.add(tx, 0)
+    assert chainservice.build_block().transaction_list == txs[1]
+    assert list(chainservice.txpool.ordered()) == txs[1]
+    invalid_tx, = mk_txs(3, [5])
+    block, invalid = BlockBuilder().build(head, head.coinbase, [invalid_tx] + ordered)
+    assert block.transaction_list == ordered and invalid == [invalid_tx]
+
+    # out of time after two txs
+    clock = iter([0, 0, 0, 2, 2]).next
+    block, _ = BlockBuilder(max_time=1, clock=clock).build(head, head.coinbase, ordered)
+    assert block.transaction_list == ordered[:2]
+
+
+class ProtoMock(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def __getattr__(self, attr):
+        assert attr.startswith('send_')
+        return lambda *args: self.sent.append((attr[5:], args))
+
+
+def test_compact_proposal(monkeypatch):
+    monkeypatch.setitem(AppMock.config['hdc'], 'compact_proposal_min_size', 1)
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    broadcasted = []
+    monkeypatch.setattr(app.services.peermanager, 'broadcast', classmethod(
+        lambda cls, proto, cmd, args, **kargs: broadcasted.append((cmd, args))))
+    txs = mk_txs(1, range(3))
+    chainservice.add_transactions(txs)
+    p = chainservice.consensus_manager.active_round.mk_proposal()
+    assert p.block.transaction_list == txs
+    chainservice.broadcast(p)
+    cmd, (cp,) = broadcasted.pop()
+    assert cmd == 'newcompactblockproposal'
+    assert broadcasted.pop()[0] == 'new_transactions'  # flushed before
+    klass = hdc_protocol.HDCProtocol.newcompactblockproposal
+    cp = klass.decode_payload(klass.encode_payload([cp]))['proposal']
+    assert len(rlp.encode(cp)) < len(rlp.encode(p))
+
+    # a peer which knows some txs requests the missing
+    receiver = hdc_service.ChainService(AppMock(privkeys[1]))
+    received = []
+    monkeypatch.setattr(receiver, 'on_receive_newblockproposal',
+                        lambda proto, p: received.append(p))
+    for tx in txs[::2]:
+        receiver.recent_transactions[tx.hash] = tx
+    proto = ProtoMock()
+    receiver.on_receive_newcompactblockproposal(proto, cp)
+    receiver.on_receive_newcompactblockproposal(proto, cp)
+    assert proto.sent == [('getblocktransactions', (p.blockhash, [1]))]
+    chainservice.on_receive_getblocktransactions(proto, p.blockhash, [1])
+    assert proto.sent[-1] == ('blocktransactions', (p.blockhash, [txs[1]]))
+    receiver.on_receive_blocktransactions(proto, p.blockhash, [txs[1]])
+    assert received == [p]
+    assert rlp.encode(received[0]) == rlp.encode(p)
+
+    # the proposal is rebuilt from the known txs
+    receiver.on_proposal_request_timeout(p.blockhash, proto)
+    receiver.recent_transactions[txs[1].hash] = txs[1]
+    receiver.on_receive_newcompactblockproposal(proto, cp)
+    assert len(proto.sent) == 2
+    assert received == [p, p]
+
+    chainservice.on_receive_getblockproposal(proto, p.blockhash)
+    assert proto.sent[-1] == ('newblockproposal', (p,))
+
+
+def test_link_block_by_candidate(monkeypatch):
+    alloc = dict((a.encode('hex'), dict(balance=1)) for a in validators)
+    monkeypatch.setitem(AppMock.config['eth'], 'block',
+                        dict(AppMock.config['eth']['block'], GENESIS_INITIAL_ALLOC=alloc))
+    proposer = hdc_service.ChainService(AppMock(privkeys[0]))
+    txs = mk_txs(3, range(3))
+    proposer.add_transactions(txs[:2])
+    p = proposer.consensus_manager.active_round.mk_proposal()
+    t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+
+    applied = []
+    apply_transaction = processblock.apply_transaction
+    monkeypatch.setattr(processblock, 'apply_transaction',
+                        lambda block, tx: applied.append(tx) or apply_transaction(block, tx))
+
+    # the block is a prefix of the txs applied by the validator w/ another coinbase
+    validator = hdc_service.ChainService(AppMock(privkeys[1]))
+    validator.add_transactions(txs)
+    candidate = validator.build_block()
+    del applied[:]
+    assert validator.verify_by_candidate(t_block, candidate)
+    key = validator.speculative.key(candidate.prevhash, candidate.get_transaction_hashes())
+    validator.speculative.candidates[key] = candidate
+    block = validator.link_block(t_block)
+    assert block.hash == t_block.hash
+    assert applied == []
+    assert validator.commit_block(block)
+    assert validator.chain.head.get_nonce(txs[0].sender) == 2
+    assert list(validator.txpool.ordered()) == txs[2:]  # still pending
+
+    # w/o the txs they are replayed
+    validator = hdc_service.ChainService(AppMock(privkeys[2]))
+    t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+    del applied[:]
+    block = validator.link_block(t_block)
+    assert block.hash == t_block.hash
+    assert applied == txs[:2]
+
+
+def test_speculative_candidate(monkeypatch):
+    alloc = dict((a.encode('hex'), dict(balance=10 ** 18)) for a in validators)
+    monkeypatch.setitem(AppMock.config['eth'], 'block',
+                        dict(AppMock.config['eth']['block'], GENESIS_INITIAL_ALLOC=alloc))
+    proposer = hdc_service.ChainService(AppMock(privkeys[0]))
+    txs = mk_txs(3, range(3), gasprice=1, value=1)
+    proposer.add_transactions(txs)
+    p = proposer.consensus_manager.active_round.mk_proposal()
+    t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+
+    # the validator w/o the txs in its head_candidate, built the block of the proposer
+    validator = hdc_service.ChainService(AppMock(privkeys[1]))
+    executor = validator.speculative
+    head = validator.chain.head
+    candidate = executor.execute(head, p.sender, txs[:2], timestamp=head.timestamp + 100)
+    assert candidate.coinbase == p.sender
+    executor.extend(head.hash, txs)
+    assert executor.lookup(t_block) == [candidate]
+    assert len(executor.candidates) == 1
+
+    applied = []
+    apply_transaction = processblock.apply_transaction
+    monkeypatch.setattr(processblock, 'apply_transaction',
+                        lambda block, tx: applied.append(tx) or apply_transaction(block, tx))
+    block = validator.link_block(t_block)
+    assert block.hash == t_block.hash
+    assert applied == []
+    assert validator.commit_block(block)
+    assert validator.chain.head.get_balance('x' * 20) == 3
+
+
+def test_candidate_context_of_specials():
+    proposer = hdc_service.ChainService(AppMock(privkeys[0]))
+    to = '\0' * 19 + '\1'  # ecrecover, as native contracts w/o code in the state
+    txs = mk_txs(3, range(2), startgas=50000, to=to)
+    proposer.add_transactions(txs)
+    p = proposer.consensus_manager.active_round.mk_proposal()
+    t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+    validator = hdc_service.ChainService(AppMock(privkeys[1]))
+    head = validator.chain.head
+    candidate = validator.speculative.execute(head, p.sender, txs, timestamp=head.timestamp + 100)
+    assert not validator.verify_by_candidate(t_block, candidate)  # they could read the context
+    candidate = validator.speculative.execute(head, p.sender, txs, timestamp=p.block.timestamp)
+    assert validator.verify_by_candidate(t_block, candidate)
+
+
+def test_pipelined_commit(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    commits, alarms = [], []
+    monkeypatch.setattr(app.services.db, 'commit', lambda: commits.append(True))
+    monkeypatch.setattr(chainservice, 'setup_alarm', lambda delay, cb, *args: alarms.append(cb))
+    p = chainservice.consensus_manager.active_round.mk_proposal()
+    assert chainservice.commit_block(p.block)
+    assert chainservice.chain.head == p.block
+    assert commits == []  # flushed after the next consensus step
+    assert chainservice.flush in alarms
+    chainservice.flush()
+    assert commits == [True]
+    chainservice.flush()
+    assert len(commits) == 1
+
+    # flushed at once if too many blocks are pending
+    chainservice.unflushed_blocks = chainservice.config['hdc']['max_unflushed_blocks']
+    chainservice.schedule_flush()
+    assert len(commits) == 2
+
+
+def test_coalesced_consensus_processing(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    processed, alarms = [], []
+    monkeypatch.setattr(chainservice.consensus_manager, 'process', lambda: processed.append(1))
+    monkeypatch.setattr(chainservice, 'setup_alarm',
+                        lambda delay, cb, *args: alarms.append((cb, args)))
+    for i in range(3):  # e.g. a burst of votes
+        chainservice.process_consensus()
+    assert len(alarms) == 1
+    cb, args = alarms.pop()
+    cb(*args)
+    assert len(processed) == 1
+    chainservice.process_consensus()
+    assert len(alarms) == 1
+
+    # callbacks after the pass, e.g. to send the voted proposal on status
+    sent = []
+    chainservice.process_consensus(sent.append, 'a')
+    cb, args = alarms.pop()
+    cb(*args)
+    assert len(processed) == 2 and sent == ['a']
+
+    # transaction alarms are set up once
+    triggered = []
+
+    def cb(i):
+        triggered.append(i)
+    alarm = chainservice.setup_transaction_alarm(cb, 1)
+    for i in range(3):
+        assert chainservice.setup_transaction_alarm(cb, 1) is alarm
+    chainservice.setup_transaction_alarm(cb, 2)
+    chainservice.setup_transaction_alarm(cb, 3).cancel()
+    assert len(chainservice.transaction_alarms) == 2
+    chainservice._on_new_head_candidate()
+    assert triggered == [1, 2]
+    chainservice._on_new_head_candidate()
+    assert triggered == [1, 2]
+    chainservice.setup_transaction_alarm(cb, 1)
+    chainservice._on_new_head_candidate()
+    assert triggered == [1, 2, 1]
+
+
+def test_consensus_worker_survives_errors(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    processed = []
+
+    def process():
+        processed.append(1)
+        if len(processed) == 1:
+            raise ValueError('failed pass')
+    monkeypatch.setattr(chainservice.consensus_manager, 'process', process)
+    chainservice.consensus_worker = gevent.spawn(chainservice.run_consensus)
+    sent = []
+    chainservice.process_consensus(sent.append, 'a')
+    gevent.sleep(0.01)
+    assert len(processed) == 1 and sent == ['a']
+    chainservice.process_consensus()
+    gevent.sleep(0.01)
+    assert len(processed) == 2
+    chainservice.consensus_worker.kill()
+
+
+def test_round_timeout_alarm_replaced():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    cm = chainservice.consensus_manager
+    assert cm.is_waiting_for_proposal
+    cm.setup_alarm()
+    alarm = cm.timeout_alarm
+    assert alarm.active and chainservice.num_alarms == 1
+    cm.setup_alarm()
+    assert cm.timeout_alarm is alarm
+    cm.active_round.timeout_time = None  # e.g. deferred
+    cm.setup_alarm()
+    assert not alarm.active
+    assert cm.timeout_alarm.active and chainservice.num_alarms == 1
+    chainservice.alarms.stop()
+
+
+def test_batched_proposals(monkeypatch):
+    monkeypatch.setitem(AppMock.config['hdc'], 'batch_window', 1.)
+    monkeypatch.setitem(AppMock.config['hdc'], 'batch_min_txs', 2)
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    cm = chainservice.consensus_manager
+    monkeypatch.setattr(cm, 'num_initial_blocks', 0)
+    assert not cm.is_waiting_for_proposal
+    txs = mk_txs(1, range(2))
+    chainservice.add_transactions(txs[:1])
+    assert not cm.is_waiting_for_proposal  # held for the window
+    cm.setup_alarm()
+    assert cm.batch_alarm.active and 0 < cm.batch_alarm.deadline - chainservice.now <= 1.
+    chainservice.add_transactions(txs[1:])
+    assert cm.is_waiting_for_proposal  # enough txs
+    cm.setup_alarm()
+    assert cm.batch_alarm is None
+    chainservice.alarms.stop()
+
+
+def test_proposal_on_first_transaction(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    cm = chainservice.consensus_manager
+    monkeypatch.setattr(cm, 'num_initial_blocks', 0)
+    cm.ready_validators = set(validators)
+    processed = []
+    monkeypatch.setattr(cm, 'process', lambda: processed.append(chainservice.now))
+    cm.setup_alarm()
+    assert cm.transaction_alarm.active
+    chainservice.add_transactions(mk_txs(1, [0]))
+    assert len(processed) == 1  # w/o a batch window, at once
+    assert cm.batch_alarm is None
+    chainservice.alarms.stop()
+
+
+def test_send_new_transactions():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    peer = PeerMock(app)
+    packets = []
+    peer.send_packet = packets.append
+    proto = hdc_protocol.HDCProtocol(peer, chainservice)
+    txs = mk_txs(1, range(3))
+    proto.mark_known_transactions(txs[:1])  # e.g. received from the peer
+    proto.send_new_transactions(*txs[:2])
+    proto.send_new_transactions(*txs)
+    proto.send_new_transactions(*txs)
+    assert len(packets) == 2
+    sent = [hdc_protocol.HDCProtocol.transactions.decode_payload(p.payload) for p in packets]
+    assert sent == [txs[1:2], txs[2:]]
+
+
 def test_broadcast_filter():
     r = Ready(0, LockSet(1))
     r.sign('x' * 32)
@@ -83,6 +527,50 @@ def test_broadcast_filter():
     assert not df.update(r)
     assert not df.update(r)
     assert r in df
+    # all lookups are counted, incl. those of received messages
+    assert df.hits == 3 and df.misses == 2
+    assert df.hit_rate == 3 / 5.
+
+
+def test_broadcast_filter_lru():
+    df = hdc_service.DuplicatesFilter(max_items=3)
+    for i in range(3):
+        assert df.update(i)
+    assert not df.update(0)  # 0 is most recently used now
+    assert df.update(3)  # evicts 1
+    assert 0 in df
+    assert 1 not in df
+    assert df.update(1)
+
+
+def test_bloom_broadcast_filter():
+    df = hdc_service.BloomDuplicatesFilter(max_items=100, fp_rate=0.01)
+    items = [utils.sha3(str(i)) for i in range(250)]
+    fps = sum(not df.update(i) for i in items[:100])
+    assert fps < 5
+    assert df.hits == fps
+    assert all(i in df for i in items[:100])
+    assert not df.update(items[0])
+    # rotates, but remembers at least max_items
+    fps = sum(not df.update(i) for i in items[100:])
+    assert fps < 5
+    assert all(i in df for i in items[150:])
+    assert sum(i in df for i in items[:50]) < 5
+
+
+def test_broadcast_filter_config():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    assert isinstance(chainservice.broadcast_filter, hdc_service.DuplicatesFilter)
+    assert chainservice.broadcast_filter.max_items == 1024
+    assert not chainservice.verifier.workers
+    app = AppMock(privkeys[0])
+    app.config = dict(app.config)
+    app.config['hdc'] = dict(validators=validators, broadcast_filter_max_items=10,
+                             broadcast_filter_fp_rate=0.01)
+    chainservice = hdc_service.ChainService(app)
+    assert isinstance(chainservice.broadcast_filter, hdc_service.BloomDuplicatesFilter)
+    assert chainservice.broadcast_filter.max_items == 10
 
 # def receive_blocks(rlp_data, leveldb=False, codernitydb=False):
 #     app = AppMock()
@@ -1,7 +1,10 @@
 from hydrachain.consensus.simulation import Network, assert_heightdistance
 from hydrachain.consensus.simulation import assert_maxrounds, assert_blocktime, log
 from hydrachain.consensus.manager import ConsensusManager
+from hydrachain.consensus.base import BlockProposal
+from hydrachain.consensus.protocol import HDCProtocol
 from ethereum.transactions import Transaction
+import rlp
 import pytest
 import gevent
 
@@ -42,6 +45,30 @@ def test_basic_singlenode():
     assert_blocktime(r, 1.5)
 
 
+def test_compact_proposal_store():
+    network = Network(num_nodes=4, simenv=True)
+    network.connect_nodes()
+    network.normvariate_base_latencies()
+    network.start()
+    network.run(5)
+    for cm in network.consensus_managers():
+        assert cm.head.number > 2
+        stored = full = 0
+        for height in range(1, cm.head.number + 1):
+            prlp = cm.store.load_proposal_rlp(height)
+            p = rlp.decode(prlp, BlockProposal)
+            assert rlp.encode(p) == prlp  # rebuilt w/o changes
+            # served w/ the aggregated locksets, incl. those referring to the previous one
+            klass = HDCProtocol.blockproposals
+            aggregated = cm.store.load_proposal_rlp(height, aggregated=True)
+            assert klass.decode_payload(klass.encode_payload((aggregated,))) == (p,)
+            assert p.blockhash == cm.chain.index.get_block_by_number(height)
+            assert p.sender == p.block.header.coinbase
+            stored += len(cm.chainservice.db.get(cm.store.proposal_key % height))
+            full += len(prlp)
+        assert stored < full / 2
+
+
 def test_transactions():
     sim_time = 5
     num_txs = 2
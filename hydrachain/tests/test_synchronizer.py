@@ -0,0 +1,177 @@
+from hydrachain.consensus.synchronizer import Synchronizer, SyncPeer
+from hydrachain.consensus.base import InvalidSignature
+import rlp
+
+
+class ProtoMock(object):
+
+    is_stopped = False
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = []
+
+    def __repr__(self):
+        return '<Proto(%s)>' % self.name
+
+    def send_getblockproposals(self, *blocknumbers):
+        self.requests.append(blocknumbers)
+
+
+class ProposalMock(rlp.Serializable):
+
+    fields = [('height', rlp.sedes.big_endian_int)]
+    signing_lockset = []
+
+
+class ChainServiceMock(object):
+
+    now = 0
+
+    def __init__(self, cm):
+        self.cm = cm
+        self.alarms = []
+
+    def setup_alarm(self, delay, cb, *args):
+        self.alarms.append((cb, args))
+
+    def process_consensus(self):
+        self.cm.synchronizer.add_proposals()
+
+
+class LockSetMock(object):
+
+    def __init__(self, height):
+        self.height = height
+
+
+class HeadMock(object):
+
+    number = 0
+
+
+class ConsensusManagerMock(object):
+
+    def __init__(self, max_height):
+        self.chainservice = ChainServiceMock(self)
+        self.head = HeadMock()
+        self.highest_committing_lockset = LockSetMock(max_height)
+        self.added = []
+
+    @property
+    def height(self):
+        return self.head.number + 1
+
+    def log(self, *args, **kargs):
+        pass
+
+    def add_vote(self, v):
+        pass
+
+    def add_proposal(self, p):
+        if getattr(p, 'invalid', False):
+            raise InvalidSignature()
+        self.added.append(p.height)
+        self.head.number = p.height  # commit immediately
+
+    def commit(self):
+        pass
+
+
+def test_syncpeer_batch_size():
+    peer = SyncPeer(ProtoMock('a'))
+    assert peer.batch_size(10, 1.) == 10  # unknown
+    peer.on_response(4, 1.)
+    assert peer.batch_size(10, 1.) == 4
+    peer.on_timeout()
+    assert peer.batch_size(10, 1.) == 2
+    assert peer.failures == 1
+
+
+def test_syncpeer_timeout():
+    peer = SyncPeer(ProtoMock('a'), default_timeout=5.)
+    assert peer.timeout == 5.
+    for i in range(10):
+        peer.on_response(10, 0.1, 1000)
+    assert peer.min_timeout <= peer.timeout < 0.6  # fast LAN peer
+    assert peer.bytes_per_proposal == 100
+    assert peer.stats['num_received'] == 100
+    timeout = peer.timeout
+    peer.on_timeout()
+    assert peer.timeout == 2 * timeout
+    peer.on_response(10, 0.1, 1000)
+    assert peer.backoff == 1
+
+    # requests grow while complete, down to what all peers serve if truncated
+    assert peer.max_count == 10
+    peer.on_response(10, 0.1, 1000, num_requested=10)
+    peer.on_response(20, 0.1, 1000, num_requested=20)
+    assert peer.max_count == 40
+    peer.on_response(10, 0.1, 1000, num_requested=40)
+    assert peer.max_count == 10
+
+    slow = SyncPeer(ProtoMock('b'), default_timeout=5.)
+    for i in range(10):
+        slow.on_response(10, 8., 1000)
+    assert slow.timeout > 8.  # slow WAN peer
+
+
+def test_parallel_requests():
+    cm = ConsensusManagerMock(max_height=100)
+    sync = cm.synchronizer = Synchronizer(cm)
+    protos = [ProtoMock(i) for i in range(3)]
+    for proto in protos:
+        sync.peers[proto] = SyncPeer(proto)
+    sync.request()
+    # each peer got max_inflight_per_peer requests with distinct ranges
+    assert all(len(p.requests) == sync.max_inflight_per_peer for p in protos)
+    requested = [h for p in protos for r in p.requests for h in r]
+    assert sorted(requested) == range(1, 61)
+    assert sync.is_syncing
+
+    requests = dict((r[0], (r, p)) for p in protos for r in p.requests)
+    first, first_proto = requests[1]
+    second, second_proto = requests[first[-1] + 1]
+
+    # out of order response is buffered
+    sync.receive_blockproposals([ProposalMock(h) for h in second], second_proto)
+    assert cm.added == []
+    assert set(second) == set(sync.proposals)
+    # the missing range is delivered, proposals are added in order
+    sync.receive_blockproposals([ProposalMock(h) for h in first], first_proto, 1000)
+    assert cm.added == list(first + second)
+    assert sync.peers[first_proto].bytes_received == 1000  # as received over the wire
+    assert not sync.proposals
+
+
+def test_timeout_reassigns():
+    cm = ConsensusManagerMock(max_height=5)
+    sync = cm.synchronizer = Synchronizer(cm)
+    slow, fast = ProtoMock('slow'), ProtoMock('fast')
+    sync.peers[slow] = SyncPeer(slow)
+    sync.request()
+    assert slow.requests == [(1, 2, 3, 4, 5)]
+    sync.peers[fast] = SyncPeer(fast)
+    sync.peers[fast].rate = 10.
+    cb, args = cm.chainservice.alarms[0]
+    cb(*args)  # timeout
+    assert fast.requests == [(1, 2, 3, 4, 5)]
+    assert sync.peers[slow].failures == 1
+    cb(*args)  # already handled
+    assert len(fast.requests) == 1
+
+
+def test_invalid_proposal_is_rerequested():
+    cm = ConsensusManagerMock(max_height=5)
+    sync = cm.synchronizer = Synchronizer(cm)
+    proto = ProtoMock('a')
+    sync.peers[proto] = SyncPeer(proto)
+    sync.request()
+    assert proto.requests == [(1, 2, 3, 4, 5)]
+    proposals = [ProposalMock(h) for h in range(1, 6)]
+    proposals[2].invalid = True  # e.g. a bad signature
+    sync.receive_blockproposals(proposals, proto)
+    assert cm.added == [1, 2]
+    assert 3 not in sync.received and not sync.add_proposals_lock.locked()
+    sync.request()
+    assert proto.requests[-1][0] == 3
@@ -0,0 +1,64 @@
+from hydrachain.txpool import TransactionPool
+from ethereum.transactions import Transaction
+
+privkeys = [chr(i) * 32 for i in range(1, 4)]
+
+
+def mk_tx(key, nonce, gasprice=1):
+    tx = Transaction(nonce, gasprice, startgas=21000, to='x' * 20, value=0, data='')
+    tx.sign(privkeys[key])
+    return tx
+
+
+def test_ordering():
+    pool = TransactionPool()
+    a = [mk_tx(0, n, gasprice) for n, gasprice in enumerate((1, 5))]
+    b = [mk_tx(1, n, gasprice) for n, gasprice in enumerate((3, 3))]
+    c = [mk_tx(2, 0, 3)]
+    for tx in a + b + c:
+        assert pool.add(tx, 0)
+    assert not pool.add(a[0], 0)  # known
+    assert not pool.add(mk_tx(0, 3), 0)  # nonce gap
+    assert len(pool) == 5
+    assert a[1].hash in pool
+    # by gas price, in nonce order per sender, in order of arrival on ties
+    assert list(pool.ordered()) == b + c + a
+
+
+def test_replace_prune_and_stale():
+    pool = TransactionPool()
+    txs = [mk_tx(0, n) for n in range(3)]
+    for tx in txs:
+        pool.add(tx, 0)
+    assert not pool.add(mk_tx(0, 1, gasprice=1), 0)
+    replacement = mk_tx(0, 1, gasprice=2)
+    assert pool.add(replacement, 0)
+    assert list(pool.ordered()) == [txs[0], replacement, txs[2]]
+    pool.prune([replacement])  # included, the earlier ones are obsolete
+    assert list(pool.ordered()) == txs[2:]
+    pool.prune([mk_tx(0, 2, gasprice=3)])  # an other tx w/ the same nonce was included
+    assert len(pool) == 0
+    for tx in txs:
+        pool.add(tx, 0)
+    assert pool.queued(txs[0].sender, 3) == []  # included elsewhere
+    assert len(pool) == 0
+    for tx in txs:
+        pool.add(tx, 0)
+    pool.remove(txs[1])  # invalid, the later ones depend on it
+    assert list(pool.ordered()) == txs[:1]
+    assert pool.startgas == 21000
+
+
+def test_limits():
+    pool = TransactionPool(max_size=3, max_per_sender=2)
+    assert pool.add(mk_tx(0, 0, 2), 0)
+    assert pool.add(mk_tx(0, 1, 2), 0)
+    assert not pool.add(mk_tx(0, 2, 5), 0)  # per sender
+    cheap = mk_tx(1, 0, 1)
+    assert pool.add(cheap, 0)
+    assert not pool.add(mk_tx(2, 0, 1), 0)  # not better than the cheapest
+    tx = mk_tx(2, 0, 3)
+    assert pool.add(tx, 0)
+    assert cheap.hash not in pool and tx.hash in pool
+    assert pool.num_evicted == 1
+    assert len(pool) == 3
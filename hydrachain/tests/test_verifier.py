@@ -0,0 +1,89 @@
+from hydrachain.consensus.base import VoteBlock, LockSet, Ready, signature_cache
+from hydrachain.consensus.base import raw_signature_keys
+from hydrachain.consensus.protocol import HDCProtocol
+from hydrachain.verifier import SignatureVerifier
+from ethereum import utils
+from ethereum.transactions import Transaction
+import rlp
+import pytest
+
+privkeys = [chr(i) * 32 for i in range(1, 4)]
+validators = [utils.privtoaddr(p) for p in privkeys]
+
+
+def create_votes(height=1):
+    votes = []
+    for privkey in privkeys:
+        v = VoteBlock(height, 0, '0' * 32)
+        v.sign(privkey)
+        votes.append(v)
+    return votes
+
+
+def create_ready():
+    ls = LockSet(len(validators), create_votes())
+    r = Ready(0, ls)
+    r.sign(privkeys[0])
+    return r
+
+
+def test_raw_signature_keys():
+    r = create_ready()
+    keys = raw_signature_keys(Ready, rlp.decode(rlp.encode(r)))
+    assert keys == [v.signature_key() for v in r.current_lockset] + [r.signature_key()]
+
+    # packet structure
+    structure = HDCProtocol.ready.structure
+    sedes = rlp.sedes.List([s for _, s in structure])
+    keys2 = raw_signature_keys(sedes, rlp.decode(rlp.encode([r], sedes)))
+    assert keys2 == keys
+
+
+def do_verifier(verifier):
+    r = create_ready()
+    signature_cache.clear()
+    keys = raw_signature_keys(Ready, rlp.decode(rlp.encode(r)))
+    invalid = (keys[0][0], 27, 0, 1)
+    addresses = verifier.recover(keys + [invalid])
+    assert addresses == validators + [validators[0], None]
+
+    # prefetched signatures are found by decoded messages
+    assert verifier.prefetch(keys + [invalid]) == len(keys) + 1
+    assert len(signature_cache) == len(keys)
+    assert verifier.prefetch(keys) == 0
+    rd = rlp.decode(rlp.encode(r), Ready)
+    assert rd.sender == validators[0]
+
+    votes = create_votes(height=2)
+    # with workers the signatures are recovered there and the remainder is found in the cache
+    assert verifier.recover_senders(votes) == (0 if verifier.workers else len(votes))
+    assert [v._sender for v in votes] == validators
+
+    # transactions
+    txs = []
+    for i, privkey in enumerate(privkeys):
+        tx = Transaction(nonce=i, gasprice=0, startgas=25000, to='', value=0, data='')
+        tx.sign(privkey)
+        tx = rlp.decode(rlp.encode(tx), Transaction)
+        assert not tx._sender
+        txs.append(tx)
+    txs.append(rlp.decode(rlp.encode(txs[0]), Transaction))
+    assert verifier.recover_tx_senders(txs) == 3
+    assert [tx._sender for tx in txs] == validators + [validators[0]]
+
+
+def test_verifier_inline():
+    verifier = SignatureVerifier()
+    assert not verifier.workers
+    do_verifier(verifier)
+
+
+def test_verifier_workers():
+    pytest.importorskip('gipc')
+    verifier = SignatureVerifier(num_workers=2)
+    try:
+        assert len(verifier.workers) == 2
+        do_verifier(verifier)
+    finally:
+        verifier.stop()
+    assert not verifier.workers
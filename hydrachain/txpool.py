@@ -0,0 +1,147 @@
+import heapq
+import itertools
+from ethereum.slogging import get_logger
+log = get_logger('hdc.txpool')
+
+
+class TransactionPool(object):
+
+    """
+    Pending transactions, not yet included in a block.
+
+    Txs are queued per sender in the order of their nonces, starting w/ the next nonce
+    of the sender on the head, so all queued txs are executable in order.
+    Blocks are built from the queues by gas price (see ordered), txs w/ the same price
+    in the order they were added.
+    If the pool is full, the last tx of the sender w/ the cheapest last tx is evicted.
+    """
+
+    def __init__(self, max_size=4096, max_per_sender=64):
+        self.max_size = max_size
+        self.max_per_sender = max_per_sender
+        self.transactions = dict()  # hash: tx
+        self.queues = dict()  # sender: [tx, ...] ordered by nonce
+        self.seq = dict()  # hash: number in the order of arrival
+        self.counter = itertools.count()
+        self.startgas = 0  # of all txs
+        self.num_evicted = 0
+
+    def __repr__(self):
+        return '<TransactionPool(txs=%d senders=%d evicted=%d)>' % \
+            (len(self), len(self.queues), self.num_evicted)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.transactions
+
+    def get(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+    def queued(self, sender, nonce):
+        "txs of sender, nonce is the one of the sender on the head"
+        self.remove_stale(sender, nonce)
+        return list(self.queues.get(sender, []))
+
+    def add(self, tx, nonce):
+        """
+        adds a tx w/ the next nonce of its sender, nonce is the one of the sender on the head.
+        a queued tx is replaced by one w/ the same nonce and a higher gas price.
+        returns True if added.
+        """
+        sender = tx.sender
+        if tx.hash in self.transactions:
+            return False
+        self.remove_stale(sender, nonce)
+        queue = self.queues.get(sender, [])
+        index = tx.nonce - nonce
+        if index < 0:
+            return False
+        elif index < len(queue):
+            old = queue[index]
+            if tx.gasprice <= old.gasprice:
+                return False
+            self._unindex(old)
+            log.debug('replacing tx', old=old, new=tx)
+        elif index > len(queue) or len(queue) >= self.max_per_sender:
+            return False
+        elif len(self.transactions) >= self.max_size and not self.evict(tx.gasprice, sender):
+            return False
+        else:
+            queue.append(None)
+        queue[index] = tx
+        self.queues[sender] = queue
+        self._index(tx)
+        return True
+
+    def _index(self, tx):
+        self.transactions[tx.hash] = tx
+        self.seq[tx.hash] = next(self.counter)
+        self.startgas += tx.startgas
+
+    def _unindex(self, tx):
+        del self.transactions[tx.hash], self.seq[tx.hash]
+        self.startgas -= tx.startgas
+
+    def evict(self, gasprice, exclude=None):
+        "evicts the cheapest last tx of a sender, if it is cheaper than gasprice"
+        tails = [(q[-1].gasprice, -self.seq[q[-1].hash], s)
+                 for s, q in self.queues.items() if s != exclude]
+        if not tails or min(tails)[0] >= gasprice:
+            return False
+        sender = min(tails)[2]
+        queue = self.queues[sender]
+        tx = queue.pop()
+        self._unindex(tx)
+        if not queue:
+            del self.queues[sender]
+        self.num_evicted += 1
+        log.debug('evicted tx', tx=tx)
+        return True
+
+    def _remove_first(self, sender, count):
+        queue = self.queues[sender]
+        for tx in queue[:count]:
+            self._unindex(tx)
+        del queue[:count]
+        if not queue:
+            del self.queues[sender]
+
+    def remove_stale(self, sender, nonce):
+        "removes the txs of sender w/ a nonce lower than the one on the head"
+        queue = self.queues.get(sender, [])
+        count = len(list(itertools.takewhile(lambda tx: tx.nonce < nonce, queue)))
+        if count:
+            self._remove_first(sender, count)
+
+    def remove(self, tx):
+        "removes the tx and the later txs of its sender, which depend on it"
+        queue = self.queues.get(tx.sender, [])
+        if tx in queue:
+            index = queue.index(tx)
+            for t in queue[index:]:
+                self._unindex(t)
+            del queue[index:]
+            if not queue:
+                del self.queues[tx.sender]
+
+    def prune(self, transactions):
+        """
+        removes the txs w/ the nonces of the included transactions and the earlier ones,
+        also if other txs w/ the same nonces were included
+        """
+        for tx in transactions:
+            self.remove_stale(tx.sender, tx.nonce + 1)
+
+    def ordered(self):
+        "yields all txs, each time the next one of the sender w/ the highest gas price"
+        heap = [(-q[0].gasprice, self.seq[q[0].hash], s, 0) for s, q in self.queues.items()]
+        heapq.heapify(heap)
+        while heap:
+            _, _, sender, index = heapq.heappop(heap)
+            queue = self.queues[sender]
+            yield queue[index]
+            if index + 1 < len(queue):
+                tx = queue[index + 1]
+                heapq.heappush(heap, (-tx.gasprice, self.seq[tx.hash], sender, index + 1))
@@ -1,9 +1,55 @@
+from collections import OrderedDict
 from Crypto.Hash import keccak
 sha3_256 = lambda x: keccak.new(digest_bits=256, data=x)
 
 def sha3(seed):
     return sha3_256(bytes(seed)).digest()
 
+
+class LRUCache(object):
+
+    "bounded mapping, evicts the least recently used items"
+
+    def __init__(self, max_items=1024):
+        self.max_items = max_items
+        self.d = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.d.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.d[key] = value  # most recently used
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.d.pop(key, None)
+        self.d[key] = value
+        if len(self.d) > self.max_items:
+            self.d.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.d
+
+    def clear(self):
+        self.d.clear()
+
+    def __len__(self):
+        return len(self.d)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
+
+    def __repr__(self):
+        return '<LRUCache(%d/%d hits=%d misses=%d)>' % (len(self), self.max_items,
+                                                        self.hits, self.misses)
+
 # colors
 
 FAIL = '\033[91m'
@@ -0,0 +1,119 @@
+import gevent
+import gevent.lock
+import rlp
+from bitcoin import N
+from ethereum.transactions import UnsignedTransaction
+from ethereum.slogging import get_logger
+from .utils import sha3
+from .consensus.base import recover_address, recover_senders, signature_cache
+from .consensus.base import InvalidSignature
+log = get_logger('hdc.verifier')
+
+
+def recover_addresses(keys):
+    "addresses for a list of (rawhash, v, r, s), None for invalid signatures"
+    addresses = []
+    for key in keys:
+        try:
+            addresses.append(recover_address(*key))
+        except InvalidSignature:
+            addresses.append(None)
+    return addresses
+
+
+def _worker(handle):
+    "runs in the worker processes"
+    while True:
+        try:
+            keys = handle.get()
+        except EOFError:  # pool stopped
+            return
+        handle.put(recover_addresses(keys))
+
+
+class SignatureVerifier(object):
+
+    """
+    Recovers signatures of Votes, Proposals and Transactions.
+
+    With num_workers > 0 the ecdsa recovery runs in worker processes and only the calling
+    greenlet waits for the results, i.e. the gevent hub keeps delivering votes and alarms.
+    With num_workers == 0 everything is recovered in the calling greenlet.
+    """
+
+    def __init__(self, num_workers=0):
+        self.num_workers = num_workers
+        self.workers = []  # (process, handle, lock)
+        self._next_worker = 0
+        if num_workers:
+            import gipc  # optional, only needed for the worker pool
+            for i in range(num_workers):
+                handle, worker_handle = gipc.pipe(duplex=True)
+                process = gipc.start_process(_worker, args=(worker_handle,), daemon=True)
+                self.workers.append((process, handle, gevent.lock.Semaphore()))
+            log.info('started verification workers', num=num_workers)
+
+    def __repr__(self):
+        return '<SignatureVerifier(workers=%d)>' % len(self.workers)
+
+    def stop(self):
+        for process, handle, lock in self.workers:
+            handle.close()
+            process.terminate()
+            process.join()
+        self.workers = []
+
+    def _recover_in_worker(self, worker, keys):
+        process, handle, lock = worker
+        with lock:
+            handle.put(keys)
+            return handle.get()
+
+    def recover(self, keys):
+        "addresses for a list of (rawhash, v, r, s), None for invalid signatures"
+        if not self.workers or not keys:
+            return recover_addresses(keys)
+        num_chunks = min(len(self.workers), len(keys))
+        size = -(-len(keys) // num_chunks)
+        jobs = []
+        for i in range(num_chunks):
+            worker = self.workers[self._next_worker]
+            self._next_worker = (self._next_worker + 1) % len(self.workers)
+            chunk = keys[i * size:(i + 1) * size]
+            jobs.append(gevent.spawn(self._recover_in_worker, worker, chunk))
+        gevent.joinall(jobs, raise_error=True)
+        return [address for job in jobs for address in job.value]
+
+    def prefetch(self, keys):
+        """
+        recovers the signatures, which are not yet known, into the signature_cache.
+        messages deserialized later on, find their senders there.
+        """
+        keys = list(set(k for k in keys if k not in signature_cache))
+        for key, address in zip(keys, self.recover(keys)):
+            if address is not None:
+                signature_cache[key] = address
+        return len(keys)
+
+    def recover_senders(self, signed):
+        "sets the senders of a list of Signed objects"
+        if self.workers:
+            self.prefetch([o.signature_key() for o in signed if o.v and not o._sender])
+        return recover_senders(signed)
+
+    def recover_tx_senders(self, transactions):
+        "sets the senders of a list of Transactions"
+        pool = dict()
+        for tx in transactions:
+            if tx._sender or not tx.v:
+                continue
+            if not (27 <= tx.v <= 28 and 0 < tx.r < N and 0 < tx.s < N):
+                continue  # left for Transaction.sender to reject
+            key = (sha3(rlp.encode(tx, UnsignedTransaction)), tx.v, tx.r, tx.s)
+            pool.setdefault(key, []).append(tx)
+        keys = pool.keys()
+        for key, address in zip(keys, self.recover(keys)):
+            if address is not None:
+                for tx in pool[key]:
+                    tx.sender = address
+        return len(keys)